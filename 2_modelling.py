@@ -18,6 +18,57 @@ import config
 import matplotlib.pyplot as plt
 import os
 
+def BuildModel(num_layer, num_neuron, seed):
+    hiddens = [num_neuron for i in range(num_layer-1)]
+
+    topology = [2] + hiddens + [1]
+
+    config.SetSeed(seed)
+    model = torch.nn.Sequential()
+    for t in range(len(topology)-1):
+        model.add_module(f'{t}-MAC', torch.nn.Linear(topology[t], topology[t+1]))
+        model.add_module(f'{t}-ACT', torch.nn.PReLU())
+    return model
+
+if sys.argv[1] == 'grid':
+    # all configurations in one process: the seeds and learning rates of each topology are trained together,
+    # the losses of the best models are collected in one tensor [seed, layer, neuron, lr, train/valid/test] as in 3_final_model.ipynb
+    SEEDs   = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    layers  = [2, 3, 4, 5, 6, 7, 8, 9]
+    neurons = [2, 3, 4, 5, 6, 7, 8, 9]
+    lrs     = [-3, -4, -5]
+
+    loaders = torch.load('constraint_data.loader')
+    train_loader, valid_loader, test_loader = loaders['train'], loaders['valid'], loaders['test']
+    data = [[torch.cat(t) for t in zip(*[(x, y) for x, y in loader])] for loader in [train_loader, valid_loader, test_loader]]
+
+    results = torch.zeros([len(SEEDs), len(layers), len(neurons), len(lrs), 3])
+    # loss curves of the models trained by earlier (interrupted) runs
+    curves = torch.load('./NNs/grid_results')['curves'] if os.path.exists('./NNs/grid_results') else {}
+    for l, num_layer in enumerate(layers):
+        for n, num_neuron in enumerate(neurons):
+            grid = [(s, m, seed, lr) for s, seed in enumerate(SEEDs) for m, lr in enumerate(lrs)]
+            setups = [f'{num_layer}_{num_neuron}_{lr}_{seed}' for _, _, seed, lr in grid]
+            todo = [i for i, exp_setup in enumerate(setups) if not os.path.exists(f'./NNs/constrainter_{exp_setup}')]
+            print(f'The experiment setup is {num_layer}_{num_neuron}, {len(todo)} of {len(grid)} models to train.')
+
+            models = [torch.load(f'./NNs/constrainter_{exp_setup}') if i not in todo else BuildModel(num_layer, num_neuron, grid[i][2])
+                      for i, exp_setup in enumerate(setups)]
+            if todo:
+                trained, train_loss, valid_loss = training.train_nn_grid([models[i] for i in todo], [10**grid[i][3] for i in todo],
+                                                                         [grid[i][2] for i in todo], train_loader, valid_loader)
+                for i, model, train_curve, valid_curve in zip(todo, trained, train_loss, valid_loss):
+                    torch.save(model, f'./NNs/constrainter_{setups[i]}')
+                    curves[setups[i]] = (train_curve, valid_curve)
+
+            with torch.no_grad():
+                for (s, m, _, _), model in zip(grid, models):
+                    for k, (x, y) in enumerate(data):
+                        results[s, l, n, m, k] = torch.nn.functional.mse_loss(model(x), y)
+
+            torch.save({'SEEDs': SEEDs, 'layers': layers, 'neurons': neurons, 'lrs': lrs, 'results': results, 'curves': curves}, './NNs/grid_results')
+    sys.exit()
+
 seed = int(sys.argv[1])
 lr   = int(sys.argv[2])
 for num_layer in range(2,10):
@@ -32,15 +83,7 @@ for num_layer in range(2,10):
             loaders = torch.load('constraint_data.loader')
             train_loader, valid_loader, test_loader = loaders['train'], loaders['valid'], loaders['test']
 
-            hiddens = [num_neuron for i in range(num_layer-1)]
-
-            topology = [2] + hiddens + [1]
-
-            config.SetSeed(seed)
-            model = torch.nn.Sequential()
-            for t in range(len(topology)-1):
-                model.add_module(f'{t}-MAC', torch.nn.Linear(topology[t], topology[t+1]))
-                model.add_module(f'{t}-ACT', torch.nn.PReLU())
+            model = BuildModel(num_layer, num_neuron, seed)
 
             lossfunction = torch.nn.MSELoss()
             optimizer = torch.optim.Adam(model.parameters(), lr=10**lr)
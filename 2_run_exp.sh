@@ -1,30 +1 @@
-sbatch 2_modelling.py 0 -3
-sbatch 2_modelling.py 0 -4
-sbatch 2_modelling.py 0 -5
-sbatch 2_modelling.py 1 -3
-sbatch 2_modelling.py 1 -4
-sbatch 2_modelling.py 1 -5
-sbatch 2_modelling.py 2 -3
-sbatch 2_modelling.py 2 -4
-sbatch 2_modelling.py 2 -5
-sbatch 2_modelling.py 3 -3
-sbatch 2_modelling.py 3 -4
-sbatch 2_modelling.py 3 -5
-sbatch 2_modelling.py 4 -3
-sbatch 2_modelling.py 4 -4
-sbatch 2_modelling.py 4 -5
-sbatch 2_modelling.py 5 -3
-sbatch 2_modelling.py 5 -4
-sbatch 2_modelling.py 5 -5
-sbatch 2_modelling.py 6 -3
-sbatch 2_modelling.py 6 -4
-sbatch 2_modelling.py 6 -5
-sbatch 2_modelling.py 7 -3
-sbatch 2_modelling.py 7 -4
-sbatch 2_modelling.py 7 -5
-sbatch 2_modelling.py 8 -3
-sbatch 2_modelling.py 8 -4
-sbatch 2_modelling.py 8 -5
-sbatch 2_modelling.py 9 -3
-sbatch 2_modelling.py 9 -4
-sbatch 2_modelling.py 9 -5
+sbatch 2_modelling.py grid
@@ -0,0 +1,68 @@
+import os
+import re
+import math
+import torch
+from concurrent.futures import ProcessPoolExecutor
+
+# evaluation of the saved constraint models ./NNs/constrainter_{num_layer}_{num_neuron}_{lr}_{seed} on train / valid / test:
+# the models are loaded and evaluated by a pool of workers, each worker reads the data once and evaluates each split in one batch,
+# the losses are kept in an index file (file name -> setup, modification time, losses), re-running only evaluates new or changed models
+
+PATTERN = re.compile(r'constrainter_(\d+)_(\d+)_(-?\d+)_(\d+)$')
+
+data = None
+
+def InitWorker(loader_file):
+    # train / valid / test as one tensor each, shared by all models evaluated by this worker
+    global data
+    torch.set_num_threads(1)
+    loaders = torch.load(loader_file)
+    data = [[torch.cat(t) for t in zip(*[(x, y) for x, y in loaders[split]])] for split in ['train', 'valid', 'test']]
+
+def EvaluateModel(filename):
+    model = torch.load(filename)
+    with torch.no_grad():
+        return [torch.nn.functional.mse_loss(model(x), y).item() for x, y in data]
+
+def EvaluateModels(path='./NNs', loader_file='constraint_data.loader', index_file=None, workers=None):
+    index_file = os.path.join(path, 'evaluation.index') if index_file is None else index_file
+    index = torch.load(index_file) if os.path.exists(index_file) else {}
+
+    setups = {}
+    for f in sorted(os.listdir(path)):
+        match = PATTERN.match(f)
+        if match:
+            num_layer, num_neuron, lr, seed = [int(v) for v in match.groups()]
+            setups[f] = {'num_layer': num_layer, 'num_neuron': num_neuron, 'lr': lr, 'seed': seed,
+                         'mtime': os.path.getmtime(os.path.join(path, f))}
+    todo = [f for f in setups if f not in index or not index[f]['mtime'] == setups[f]['mtime']]
+    print(f'{len(setups)} models, {len(todo)} to evaluate.')
+
+    filenames = [os.path.join(path, f) for f in todo]
+    workers = os.cpu_count() if workers is None else workers
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(workers, initializer=InitWorker, initargs=(loader_file,)) as pool:
+            losses = list(pool.map(EvaluateModel, filenames, chunksize=max(1, len(todo) // (4 * workers))))
+    else:
+        InitWorker(loader_file)
+        losses = [EvaluateModel(f) for f in filenames]
+
+    for f, loss in zip(todo, losses):
+        index[f] = {**setups[f], 'loss': loss}
+    if todo:
+        torch.save(index, index_file)
+    return index
+
+def ResultTensor(index, SEEDs, layers, neurons, lrs):
+    # losses as [seed, layer, neuron, lr, train/valid/test] as in 3_final_model.ipynb, nan for models that are not in the index
+    results = torch.full([len(SEEDs), len(layers), len(neurons), len(lrs), 3], math.nan)
+    for entry in index.values():
+        if entry['seed'] in SEEDs and entry['num_layer'] in layers and entry['num_neuron'] in neurons and entry['lr'] in lrs:
+            results[SEEDs.index(entry['seed']), layers.index(entry['num_layer']),
+                    neurons.index(entry['num_neuron']), lrs.index(entry['lr'])] = torch.tensor(entry['loss'])
+    return results
+
+def Grid(x_min, x_max, y_min, y_max, N=500):
+    # [N*N, 2] grid points, the second coordinate runs fastest
+    x, y = torch.meshgrid(torch.linspace(x_min, x_max, N), torch.linspace(y_min, y_max, N), indexing='ij')
+    return torch.stack([x.reshape(-1), y.reshape(-1)], dim=1)
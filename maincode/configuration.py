@@ -47,12 +47,14 @@ parser.add_argument('--InputNoise',            type=float,     default=0.,
 parser.add_argument('--IN_test',               type=float,     default=0.,                    help='noise of input signal for test')
 parser.add_argument('--R_train',               type=int,       default=1,                     help='number of sampling for input noise in training')
 parser.add_argument('--R_test',                type=int,       default=1,                     help='number of sampling for input noise in testing')
+parser.add_argument('--MAX_BATCH',             type=int,       default=0,                     help='maximal number of noisy samples of a split evaluated at once, 0 for full batch')
 # regularization
 parser.add_argument('--pathnorm',              type=str2bool,  default=False,                 help='path-norm as regularization for improving robustness against input noise')
 # network-related
 parser.add_argument('--hidden',                type=list,      default=[3],                   help='topology of the hidden layers')
 # training-related
 parser.add_argument('--SEED',                  type=int,       default=0,                     help='random seed')
+parser.add_argument('--N_SEED',                type=int,       default=1,                     help='number of seeds (SEED, SEED+1, ...) trained in lockstep by experiment_multiseed.py')
 parser.add_argument('--DEVICE',                type=str,       default='cpu',                 help='device for training')
 parser.add_argument('--EPOCH',                 type=int,       default=10**10,                help='maximal epochs')
 parser.add_argument('--LR',                    type=float,     default=0.1,                   help='learning rate')
@@ -63,9 +65,16 @@ parser.add_argument('--LR_MIN',                type=float,     default=1e-4,
 # regarding augmented lagrangian for (in)equality constratins
 parser.add_argument('--lambda_',               type=float,     default=0.,                    help='')
 parser.add_argument('--mu',                    type=float,     default=0.,                   help='')
+parser.add_argument('--AL_MU_UPDATE',          type=str,       default='add',                 help='growth of the penalty factor mu: add, mul (mu *= AL_MU_FACTOR as originally), adaptive')
+parser.add_argument('--AL_MU_STEP',            type=float,     default=100.,                  help='increment of mu (add), minimal mu (adaptive)')
+parser.add_argument('--AL_MU_FACTOR',          type=float,     default=1.5,                   help='factor of mu (mul, adaptive)')
+parser.add_argument('--AL_DECREASE',           type=float,     default=0.25,                  help='mu is kept if the constraint violation decreases below this fraction (adaptive)')
+parser.add_argument('--AL_TOL',                type=float,     default=0.,                    help='tolerated violation of the power constraint (in W)')
+parser.add_argument('--AL_LR_MIN',             type=float,     default=0.,                    help='learning rate at which inexact inner solves stop for a multiplier update, 0 for exact solves down to LR_MIN')
 
 # metrics
 parser.add_argument('--metric',                type=str,       default='acc',                 help='nominal accuracy or measuring-aware accuracy')
+parser.add_argument('--compile',               type=str2bool,  default=False,                 help='forward pass and power of the pNN compiled by torch.compile, falls back to eager execution')
 # server-related
 parser.add_argument('--TIMELIMITATION',        type=float,     default=70,                    help='maximal running time (in hour)')
 
@@ -82,22 +91,32 @@ parser.add_argument('--integration',           type=str,       default='MC',
 parser.add_argument('--N_train',               type=int,       default=1,                     help='number of sampling for variation during training')
 parser.add_argument('--e_train',               type=float,     default=0.,                    help='variation during training')
 parser.add_argument('--N_test',                type=int,       default=1,                     help='number of sampling for variation for testing')
-parser.add_argument('--e_test',                type=int,       default=0.,                    help='variation for testing')
+parser.add_argument('--e_test',                type=float,     default=0.,                    help='variation for testing')
+parser.add_argument('--MC_CHUNK',              type=int,       default=256,                   help='number of perturbed circuits evaluated at once in experiment_montecarlo.py, 0 for all')
 # power
 parser.add_argument('--powerestimator',        type=str,       default='power',               help='the penalty term for encouraging lower energy')
 parser.add_argument('--powerbalance',          type=float,     default=0.8,                   help='the scaling term for energy')
 parser.add_argument('--estimatorbalance',      type=float,     default=0.1,                   help='the scaling term for energy')
 parser.add_argument('--pgmin',                 type=float,     default=1e-7  ,                help='minimal printable conductance gmin')
+parser.add_argument('--activation',            type=str,       default='tanh',                help='printed activation circuit: tanh or sigmoid')
 parser.add_argument('--lnc',                   type=str2bool,  default=True,                  help='shared learnable nonlinear components')
+parser.add_argument('--surrogate',             type=str,       default='mlp',                 help='eta and power of the nonlinear circuits from the surrogate MLPs (mlp) or their linearized table (lut)')
+parser.add_argument('--lut_tol',               type=float,     default=0.,                    help='rebuild the surrogate table once its input moved by more than lut_tol, 0 for exact values')
+parser.add_argument('--compact',               type=str2bool,  default=False,                 help='fine tune the pNN with the pruned neurons and crossbar cells removed (not in experiment_multiseed.py)')
 parser.add_argument('--POWER',                 type=float,     default=500.,                  help='predefined power consumption for equality constraint')
+parser.add_argument('--POWER_LIST',            type=float,     default=[], nargs='+',         help='power budgets walked in order by experiment_sweep.py')
+parser.add_argument('--WARM_LR',               type=float,     default=0.,                    help='initial learning rate of warm started budgets in experiment_sweep.py, 0 for LR')
 
 
 # log-file-related information
 parser.add_argument('--projectname',           type=str,       default='project',             help='name of the project')
 parser.add_argument('--temppath',              type=str,       default='/temp',               help='path to temp files')
 parser.add_argument('--logfilepath',           type=str,       default='/log',                help='path to log files')
+parser.add_argument('--ckp_freq',              type=int,       default=100,                   help='write the best network to the temp file for crash recovery in every N epochs, 0 for only at the end')
 parser.add_argument('--report_freq',           type=int,       default=50,                    help='write log in every N epochs')
 parser.add_argument('--recording',             type=str2bool,  default=False,                 help='save information in each epoch')
+parser.add_argument('--record_freq',           type=int,       default=1,                     help='save information in every N epochs, 0 for no recording')
 parser.add_argument('--recordpath',            type=str,       default='/record',             help='save information in each epoch')
 parser.add_argument('--savepath',              type=str,       default='/experiment',         help='save information in each epoch')
+parser.add_argument('--resultfile',            type=str,       default='./results.jsonl',     help='append-only index of the results of PT and FT')
 parser.add_argument('--loglevel',              type=str,       default='info',                help='level of message logger')
\ No newline at end of file
@@ -50,6 +50,7 @@ def PT(pnn, train_loader, valid_loader, args, msglogger, setup):
         msglogger.info('Pretraining is finished.')
     else:
         msglogger.warning('Time out, further training is necessary.')
+    WriteResult(args, pnn, 'PT', setup, datainfo, valid_loader, test_loader, finished=best)
         
 
 def FT(train_loader, valid_loader, args, msglogger, setup):
@@ -67,6 +68,9 @@ def FT(train_loader, valid_loader, args, msglogger, setup):
     msglogger.info(information)
     print(information)
     
+    if args.compact:
+        pnn.Compact()
+
     msglogger.info('Fine tuning...')
     optimizer = torch.optim.Adam(pnn.GetParam(), lr=args.LR)
     if args.powerestimator == 'AL':
@@ -76,11 +80,14 @@ def FT(train_loader, valid_loader, args, msglogger, setup):
     if best:
         if not os.path.exists(f'{args.savepath}/'):
             os.makedirs(f'{args.savepath}/')
+        # saved as dense pNN
+        pnn.Expand()
         torch.save(pnn, f'{args.savepath}/pNN_{setup}_FT.model')
         # os.remove(f'{args.savepath}/pNN_{setup}.lf')
         msglogger.info('Fine tuning is finished.')
     else:
         msglogger.warning('Time out, further training is necessary.') 
+    WriteResult(args, pnn.Expand(), 'FT', setup, datainfo, valid_loader, test_loader, finished=best, pruned=(N1, N2, N3, P1, P2, P3))
 
 
 if os.path.isfile(f'{args.savepath}/pNN_{setup}_FT.model'):
@@ -0,0 +1,44 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), 'utils'))
+from configuration import *
+import time
+import torch
+import numpy as np
+import pNN_Power_Aware as pNN
+from utils import *
+
+# Monte Carlo evaluation of a fine tuned pNN of experiment.py on the test set under printing variation (N_test, e_test),
+# aging (M_test, K_test, t_test_max) and input noise (R_test, IN_test), e.g.
+#   python experiment_montecarlo.py --DATASET 6 --powerestimator AL --POWER 500 --N_test 100 --e_test 0.1 --M_test 10 --K_test 10 --projectname ...
+# the performance and power of each perturbed circuit are saved to {savepath}/MC_{setup}.npz
+
+args = parser.parse_args()
+if args.powerestimator == 'AL':
+    args.powerbalance = args.POWER
+args.POWER *= 1e-6
+args = FormulateArgs(args)
+MakeFolder(args)
+
+test_loader, datainfo = GetDataLoader(args, 'test')
+SetSeed(args.SEED)
+
+setup = f"data_{datainfo['dataname']}_seed_{args.SEED}_Penalty_{args.powerestimator}_Factor_{int(args.powerbalance):04d}"
+modelfile = f'{args.savepath}/pNN_{setup}_FT.model'
+if not os.path.isfile(modelfile):
+    sys.exit(f'{modelfile} does not exist.')
+
+pnn = torch.load(modelfile).to(args.DEVICE)
+pnn.UpdateArgs(args)
+
+start_time = time.time()
+montecarlo = MonteCarloEvaluator(args)
+performance, power = montecarlo(pnn, test_loader.dataset.X_test, test_loader.dataset.y_test)
+end_time = time.time()
+
+np.savez(f'{args.savepath}/MC_{setup}.npz', performance=performance, power=power,
+         N_test=args.N_test, e_test=args.e_test, M_test=args.M_test, K_test=args.K_test, t_test_max=args.t_test_max, R_test=args.R_test, IN_test=args.IN_test)
+print(f'{setup}: {performance.size} circuits in {end_time-start_time:.1f} s.')
+print(f'{args.metric}:'.ljust(8) + MonteCarloSummary(performance))
+print('power:'.ljust(8) + MonteCarloSummary(power, 1e6) + ' (uW)')
@@ -0,0 +1,120 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), 'utils'))
+from configuration import *
+import copy
+import torch
+import pprint
+import pNN_Power_Aware as pNN
+from utils import *
+
+# trains the seeds SEED, ..., SEED+N_SEED-1 of one experiment in lockstep in a single process,
+# results are saved with the same names as by experiment.py
+
+args = parser.parse_args()
+if args.powerestimator == 'AL':
+    args.powerbalance = args.POWER
+args.POWER *= 1e-6
+args = FormulateArgs(args)
+
+print(f'Training network on device: {args.DEVICE}.')
+MakeFolder(args)
+
+train_loader, datainfo = GetDataLoader(args, 'train')
+valid_loader, datainfo = GetDataLoader(args, 'valid')
+test_loader, datainfo = GetDataLoader(args, 'test')
+pprint.pprint(datainfo)
+
+topology = [datainfo['N_feature']] + args.hidden + [datainfo['N_class']]
+
+# each seed has its own copy of args, as the lagrangian multipliers are kept in args
+seeds = []
+for seed in range(args.SEED, args.SEED + args.N_SEED):
+    seed_args = copy.copy(args)
+    seed_args.SEED = seed
+    setup = f"data_{datainfo['dataname']}_seed_{seed}_Penalty_{args.powerestimator}_Factor_{int(args.powerbalance):04d}"
+    msglogger = GetMessageLogger(seed_args, setup)
+    msglogger.info(f'Training network on device: {args.DEVICE}.')
+    msglogger.info(f'Training setup: {setup}.')
+    msglogger.info(datainfo)
+    seeds.append((seed_args, setup, msglogger))
+
+
+# random generator of the input noise of each seed
+generators = {}
+
+
+def PT(seeds):
+    states = []
+    for seed_args, setup, msglogger in seeds:
+        SetSeed(seed_args.SEED)
+        msglogger.info(f'Topology of the network: {topology}.')
+        pnn = pNN.pNN(topology, seed_args).to(args.DEVICE)
+        lossfunction = pNN.Lossfunction(seed_args).to(args.DEVICE)
+        optimizer = torch.optim.Adam(pnn.GetParam(), lr=args.LR)
+        # the input noise continues the random stream of the seed after the initialization, as in experiment.py
+        generator = torch.Generator()
+        generator.set_state(torch.random.get_rng_state())
+        generators[seed_args.SEED] = generator
+        states.append(SeedState(pnn, lossfunction, optimizer, seed_args, msglogger, generator, UUID=setup+'_PT_lockstep'))
+
+    best = lockstep_train_pnn(states, train_loader, valid_loader, args)
+
+    # seeds that converged before the time limit are saved, the others are trained again in the next run
+    for s, (seed_args, setup, msglogger) in zip(states, seeds):
+        if s.finished:
+            torch.save(s.nn, f'{args.savepath}/pNN_{setup}.model')
+            msglogger.info('Pretraining is finished.')
+        else:
+            msglogger.warning('Time out, further training is necessary.')
+    return best
+
+
+def FT(seeds):
+    states = []
+    for seed_args, setup, msglogger in seeds:
+        pnn = torch.load(f'{args.savepath}/pNN_{setup}.model').to(args.DEVICE)
+        pnn.UpdateArgs(seed_args)
+        lossfunction = pNN.Lossfunction(seed_args).to(args.DEVICE)
+        lossfunction.args.mu = 0.
+        lossfunction.args.lambda_ = 0.
+
+        # Pruning
+        msglogger.info('Pruning...')
+        N1, N2, N3, P1, P2, P3 = pnn.pruning
+        information = f'{N2} ({P2*100:.2f}%) activations and {N3} ({P3*100:.2f}%) negation circuits are pruned.'
+        msglogger.info(information)
+        print(f'Seed {seed_args.SEED}: {information}')
+
+        msglogger.info('Fine tuning...')
+        optimizer = torch.optim.Adam(pnn.GetParam(), lr=args.LR)
+        # after pretraining in this process the random stream of the seed continues, otherwise it starts from the seed
+        states.append(SeedState(pnn, lossfunction, optimizer, seed_args, msglogger, generators.get(seed_args.SEED), UUID=setup+'_FT_lockstep'))
+
+    lockstep_train_pnn(states, train_loader, valid_loader, args)
+
+    for s, (seed_args, setup, msglogger) in zip(states, seeds):
+        if s.finished:
+            torch.save(s.nn, f'{args.savepath}/pNN_{setup}_FT.model')
+            msglogger.info('Fine tuning is finished.')
+        else:
+            msglogger.warning('Time out, further training is necessary.')
+
+
+to_pretrain = []
+to_finetune = []
+for seed_args, setup, msglogger in seeds:
+    if os.path.isfile(f'{args.savepath}/pNN_{setup}_FT.model'):
+        print(f'{setup}_FT exists, skip this training.')
+        msglogger.info('Training was already finished.')
+    elif os.path.isfile(f'{args.savepath}/pNN_{setup}.model'):
+        print(f'{setup} is pretrained, now fine tuning.')
+        to_finetune.append((seed_args, setup, msglogger))
+    else:
+        to_pretrain.append((seed_args, setup, msglogger))
+
+if to_pretrain and PT(to_pretrain):
+    to_finetune = to_finetune + to_pretrain
+if to_finetune:
+    FT(to_finetune)
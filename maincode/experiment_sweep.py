@@ -0,0 +1,186 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), 'utils'))
+from configuration import *
+import copy
+import json
+import time
+import torch
+import pprint
+import pNN_Power_Aware as pNN
+from utils import *
+
+# walks the power budgets POWER_LIST (in uW) in the given order, the augmented lagrangian solve of each budget
+# is warm started from the pretrained pNN and the lagrangian multipliers of the previous budget,
+# models are saved with the same names as by experiment.py, results of all budgets are appended to one file and to the results index,
+# a budget that runs into the time limit is not saved (only marked as unfinished in the index) and the sweep stops, such that it is redone after a restart
+
+args = parser.parse_args()
+args.powerestimator = 'AL'
+args = FormulateArgs(args)
+
+print(f'Training network on device: {args.DEVICE}.')
+MakeFolder(args)
+
+train_loader, datainfo = GetDataLoader(args, 'train')
+valid_loader, datainfo = GetDataLoader(args, 'valid')
+test_loader, datainfo = GetDataLoader(args, 'test')
+pprint.pprint(datainfo)
+
+topology = [datainfo['N_feature']] + args.hidden + [datainfo['N_class']]
+
+# one line per budget, the multipliers after pretraining are read back to warm start the next budget after a restart
+COLUMNS = ['POWER', 'lambda', 'mu', 'PT_valid_acc', 'PT_test_acc', 'PT_test_power', 'FT_valid_acc', 'FT_test_acc', 'FT_test_power', 'time']
+resultfile = f"{args.savepath}/sweep_data_{datainfo['dataname']}_seed_{args.SEED}_Penalty_AL.txt"
+
+
+def ReadSweep():
+    results = {}
+    if os.path.isfile(resultfile):
+        with open(resultfile, 'r') as f:
+            for line in f.readlines()[1:]:
+                values = [float(v) for v in line.split()]
+                results[values[0]] = dict(zip(COLUMNS, values))
+    return results
+
+
+def WriteSweep(result):
+    if not os.path.isfile(resultfile):
+        with open(resultfile, 'w') as f:
+            f.write(' '.join([c.ljust(14) for c in COLUMNS]) + '\n')
+    with open(resultfile, 'a') as f:
+        f.write(' '.join([f'{result[c]:<14.6e}' for c in COLUMNS]) + '\n')
+        f.flush()
+
+
+def MultiplierFile(setup):
+    # final lambda and mu of the pretraining of a budget, read back when the budget resumes from its pretrained pNN
+    return f'{args.savepath}/pNN_{setup}.multipliers'
+
+
+def Evaluate(pnn, loader, args):
+    evaluator = Evaluator(args)
+    evaluator.SelectMetric()
+    performance, power = EvaluateRecord(pnn, loader, evaluator)
+    return performance, power['total'] * 1e-6
+
+
+def PT(pnn, budget_args, msglogger, setup):
+    lossfunction = pNN.Lossfunction(budget_args).to(args.DEVICE)
+    optimizer = torch.optim.Adam(pnn.GetParam(), lr=budget_args.LR)
+    pnn, best, lossfunction = al_train_pnn_progressive(pnn, train_loader, valid_loader, lossfunction, optimizer, budget_args, msglogger, UUID=setup+'_PT')
+    if best:
+        # the multipliers are written before the model, such that a pretrained model always has them
+        with open(MultiplierFile(setup), 'w') as f:
+            json.dump({'lambda': budget_args.lambda_, 'mu': budget_args.mu}, f)
+        torch.save(pnn, f'{args.savepath}/pNN_{setup}.model')
+        msglogger.info('Pretraining is finished.')
+    else:
+        msglogger.warning('Time out, further training is necessary.')
+    WriteResult(budget_args, pnn, 'PT', setup, datainfo, valid_loader, test_loader, finished=best)
+    return pnn, best
+
+
+def FT(budget_args, msglogger, setup):
+    pnn = torch.load(f'{args.savepath}/pNN_{setup}.model').to(args.DEVICE)
+    pnn.UpdateArgs(budget_args)
+    lossfunction = pNN.Lossfunction(budget_args).to(args.DEVICE)
+    lossfunction.args.mu = 0.
+    lossfunction.args.lambda_ = 0.
+
+    # Pruning
+    msglogger.info('Pruning...')
+    print('Pruning...')
+    N1, N2, N3, P1, P2, P3 = pnn.pruning
+    information = f'{N2} ({P2*100:.2f}%) activations and {N3} ({P3*100:.2f}%) negation circuits are pruned.'
+    msglogger.info(information)
+    print(information)
+
+    if args.compact:
+        pnn.Compact()
+
+    msglogger.info('Fine tuning...')
+    optimizer = torch.optim.Adam(pnn.GetParam(), lr=budget_args.LR)
+    pnn, best, lossfunction = al_train_pnn_progressive(pnn, train_loader, valid_loader, lossfunction, optimizer, budget_args, msglogger, UUID=setup+'_FT')
+    # saved as dense pNN
+    pnn.Expand()
+    if best:
+        torch.save(pnn, f'{args.savepath}/pNN_{setup}_FT.model')
+        msglogger.info('Fine tuning is finished.')
+    else:
+        msglogger.warning('Time out, further training is necessary.')
+    WriteResult(budget_args, pnn, 'FT', setup, datainfo, valid_loader, test_loader, finished=best, pruned=(N1, N2, N3, P1, P2, P3))
+    return pnn, best
+
+
+results = ReadSweep()
+previous = None
+for budget in args.POWER_LIST:
+    start_time = time.time()
+
+    budget_args = copy.copy(args)
+    budget_args.powerbalance = budget
+    budget_args.POWER = budget * 1e-6
+
+    setup = f"data_{datainfo['dataname']}_seed_{args.SEED}_Penalty_{args.powerestimator}_Factor_{int(budget_args.powerbalance):04d}"
+    print(f'Training setup: {setup}.')
+
+    if budget in results:
+        print(f'{setup} is in {resultfile}, skip this budget.')
+        previous = (setup, results[budget])
+        continue
+
+    msglogger = GetMessageLogger(budget_args, setup)
+    msglogger.info(f'Training network on device: {args.DEVICE}.')
+    msglogger.info(f'Training setup: {setup}.')
+    msglogger.info(datainfo)
+
+    if os.path.isfile(f'{args.savepath}/pNN_{setup}.model'):
+        print(f'{setup} is pretrained, now fine tuning.')
+        pnn = torch.load(f'{args.savepath}/pNN_{setup}.model').to(args.DEVICE)
+        pnn.UpdateArgs(budget_args)
+        if os.path.isfile(MultiplierFile(setup)):
+            with open(MultiplierFile(setup), 'r') as f:
+                multipliers = json.load(f)
+            budget_args.lambda_, budget_args.mu = multipliers['lambda'], multipliers['mu']
+        elif previous is not None:
+            # pretrained without stored multipliers, continue from the ones of the previous budget
+            msglogger.warning(f'No multipliers of {setup}, continue from the ones of {previous[0]}.')
+            budget_args.lambda_, budget_args.mu = previous[1]['lambda'], previous[1]['mu']
+    elif previous is None:
+        msglogger.info(f'Topology of the network: {topology}.')
+        SetSeed(args.SEED)
+        pnn = pNN.pNN(topology, budget_args).to(args.DEVICE)
+        pnn, best = PT(pnn, budget_args, msglogger, setup)
+        if not best:
+            break
+    else:
+        # warm start from the pretrained pNN and multipliers of the previous budget
+        msglogger.info(f'Warm start from {previous[0]}.')
+        print(f'Warm start from {previous[0]}.')
+        pnn = torch.load(f'{args.savepath}/pNN_{previous[0]}.model').to(args.DEVICE)
+        pnn.UpdateArgs(budget_args)
+        budget_args.lambda_, budget_args.mu = previous[1]['lambda'], previous[1]['mu']
+        if args.WARM_LR:
+            budget_args.LR = args.WARM_LR
+        pnn, best = PT(pnn, budget_args, msglogger, setup)
+        if not best:
+            break
+
+    result = {'POWER': budget, 'lambda': budget_args.lambda_, 'mu': budget_args.mu}
+    result['PT_valid_acc'], _ = Evaluate(pnn, valid_loader, budget_args)
+    result['PT_test_acc'], result['PT_test_power'] = Evaluate(pnn, test_loader, budget_args)
+
+    ft_args = copy.copy(budget_args)
+    ft_args.LR = args.LR
+    pnn, best = FT(ft_args, msglogger, setup)
+    if not best:
+        break
+    result['FT_valid_acc'], _ = Evaluate(pnn, valid_loader, ft_args)
+    result['FT_test_acc'], result['FT_test_power'] = Evaluate(pnn, test_loader, ft_args)
+    result['time'] = time.time() - start_time
+
+    WriteSweep(result)
+    msglogger.info(f'Result is written to {resultfile}.')
+    previous = (setup, result)
@@ -1,36 +1,120 @@
 import numpy as np
 import torch
 
+# ================================================================================================================================================
+# ============================================================  Step-scoped Caching  =============================================================
+# ================================================================================================================================================
+
+class StepCache():
+    # memoize tensors derived from a parameter, valid as long as the parameter is not updated
+    # a cached tensor is dropped once
+    #   - the parameter is modified in place (e.g. optimizer.step()), which increments its version counter
+    #   - the autograd mode changes, as tensors from no_grad() carry no graph
+    #   - backward has passed through it, as its graph is freed afterwards
+    #   - ClearCache() is called, e.g. after masks or args are changed
+    def Cached(self, name, parameter, compute):
+        # inside a graph traced by torch.compile the tensors are recomputed, common subexpressions are shared by the compiler
+        if torch.compiler.is_compiling():
+            return compute()
+        cache = self.__dict__.setdefault('_step_cache', {})
+        key = (parameter._version, parameter.data_ptr(), torch.is_grad_enabled())
+        if name in cache and cache[name][0] == key:
+            return cache[name][1]
+        value = compute()
+        key = (parameter._version, parameter.data_ptr(), torch.is_grad_enabled())
+        if value.requires_grad:
+            value.register_hook(lambda grad: self._Invalidate(name, value))
+        cache[name] = (key, value)
+        return value
+
+    def _Invalidate(self, name, value):
+        cache = self.__dict__.get('_step_cache', {})
+        if name in cache and cache[name][1] is value:
+            del cache[name]
+
+    def ClearCache(self):
+        self.__dict__['_step_cache'] = {}
+
+    def __getstate__(self):
+        # cached tensors are transient and are neither saved nor copied
+        state = self.__dict__.copy()
+        state.pop('_step_cache', None)
+        return state
+
+# ================================================================================================================================================
+# ============================================================  Surrogate Registry  ==============================================================
+# ================================================================================================================================================
+# surrogate models (eta and power) of the printed nonlinear circuits, each package is loaded once per process and device,
+# all circuits and pNNs built afterwards share the same estimators and normalization constants
+SURROGATE_PACKAGES = {'neg':          ('neg_param.package',          'neg_power.package'),
+                      'tanh':         ('act_model_package',          'act_power_model_package'),
+                      'sigmoid':      ('sigmoid_param.package',      'sigmoid_power.package'),
+                      'hard_sigmoid': ('hard_sigmoid_param.package', 'hard_sigmoid_power.package'),
+                      'relu':         ('ReLU_param.package',         'ReLU_power.package')}
+
+SURROGATES = {}
+
+def LoadSurrogate(circuit, device='cpu'):
+    key = (circuit, str(device))
+    if key not in SURROGATES:
+        if circuit not in SURROGATE_PACKAGES:
+            raise ValueError(f'unknown nonlinear circuit: {circuit}')
+        eta_file, power_file = SURROGATE_PACKAGES[circuit]
+        package = torch.load(f'./utils/{eta_file}')
+        power_package = torch.load(f'./utils/{power_file}')
+        surrogate = {'eta_estimator': package['eta_estimator'].to(device),
+                     'power_estimator': power_package['power_estimator'].to(device)}
+        for estimator in surrogate.values():
+            estimator.train(False)
+            for p in estimator.parameters():
+                p.requires_grad = False
+        for name in ['X_max', 'X_min', 'Y_max', 'Y_min']:
+            surrogate[name] = package[name].to(device)
+            surrogate[f'pow_{name}'] = power_package[name].to(device)
+        SURROGATES[key] = surrogate
+    return SURROGATES[key]
+
+# ================================================================================================================================================
+# ============================================================  Tabulated Surrogates  ============================================================
+# ================================================================================================================================================
+
+class SurrogateTable():
+    # the surrogate MLPs (linear layers with PReLU) are piecewise linear in their input RTn_extend,
+    # with args.surrogate = 'lut' an MLP is replaced by a table of its value and jacobian at an anchor x_0, interpolated linearly
+    #   y(x) = y(x_0) + J(x_0) (x - x_0)
+    # which is exact as long as x stays in the linear piece of x_0,
+    # the table is rebuilt once x moved by more than args.lut_tol (max norm) from x_0, with lut_tol = 0 as soon as x changes,
+    # i.e., a frozen rt_ (lnc false, evaluation) costs no evaluation of the MLPs after the first forward pass
+    def Estimate(self, name, x):
+        estimator = getattr(self, f'{name}_estimator')
+        if not getattr(self.args, 'surrogate', 'mlp') == 'lut' or torch.compiler.is_compiling():
+            return estimator(x)
+        # tables are kept with the cached tensors, they are neither saved nor copied
+        cache = self.__dict__.setdefault('_step_cache', {})
+        table = cache.get(f'{name}_table')
+        if table is None or (x.detach() - table[0]).abs().max() > self.args.lut_tol:
+            x_0 = x.detach().clone()
+            with torch.no_grad():
+                y_0 = estimator(x_0)
+            J = torch.autograd.functional.jacobian(estimator, x_0, vectorize=True)
+            table = (x_0, y_0, J)
+            cache[f'{name}_table'] = table
+        x_0, y_0, J = table
+        return y_0 + torch.matmul(J, x - x_0)
+
 # ================================================================================================================================================
 # =====================================================  Learnable Negative Weight Circuit  ======================================================
 # ================================================================================================================================================
 
-class InvRT(torch.nn.Module):
+class InvRT(StepCache, SurrogateTable, torch.nn.Module):
     def __init__(self, args):
         super().__init__()
         self.args = args
         # R1, R2, R3, W1, L1, W2, L2, W3, L3
         self.rt_ = torch.nn.Parameter(torch.tensor([args.NEG_R1n, args.NEG_R2n, args.NEG_R3n, args.NEG_W1n, args.NEG_L1n, args.NEG_W2n, args.NEG_L2n, args.NEG_W3n, args.NEG_L3n]).to(args.DEVICE), requires_grad=True)
-        # model
-        package = torch.load('./utils/neg_param.package')
-        self.eta_estimator = package['eta_estimator'].to(self.DEVICE)
-        self.eta_estimator.train(False)
-        for name, param in self.eta_estimator.named_parameters():
-            param.requires_grad = False
-        self.X_max = package['X_max'].to(self.DEVICE)
-        self.X_min = package['X_min'].to(self.DEVICE)
-        self.Y_max = package['Y_max'].to(self.DEVICE)
-        self.Y_min = package['Y_min'].to(self.DEVICE)
-        # load power model
-        package = torch.load('./utils/neg_power.package')
-        self.power_estimator = package['power_estimator'].to(self.DEVICE)
-        for name, param in self.power_estimator.named_parameters():
-            param.requires_grad = False
-        self.power_estimator.train(False)
-        self.pow_X_max = package['X_max'].to(self.DEVICE)
-        self.pow_X_min = package['X_min'].to(self.DEVICE)
-        self.pow_Y_max = package['Y_max'].to(self.DEVICE)
-        self.pow_Y_min = package['Y_min'].to(self.DEVICE)
+        # surrogate models
+        for name, value in LoadSurrogate('neg', self.DEVICE).items():
+            setattr(self, name, value)
 
     @property
     def DEVICE(self):
@@ -38,6 +122,9 @@ class InvRT(torch.nn.Module):
     
     @property
     def RT(self):
+        return self.Cached('RT', self.rt_, self._RT)
+
+    def _RT(self):
         # keep values in (0,1)
         rt_temp = torch.sigmoid(self.rt_)
         RTn = torch.zeros([12]).to(self.DEVICE)
@@ -48,39 +135,55 @@ class InvRT(torch.nn.Module):
 
     @property
     def RTn_extend(self):
-        RT_extend = torch.stack([self.RT[0], self.RT[1], self.RT[2], self.RT[3],
-                                 self.RT[4], self.RT[5], self.RT[6], self.RT[7],
-                                 self.RT[8], self.RT[3]/self.RT[4], self.RT[5]/self.RT[6],
-                                 self.RT[7]/self.RT[8]])
+        return self.Cached('RTn_extend', self.rt_, self._RTn_extend)
+
+    def _RTn_extend(self):
+        RT = self.RT
+        RT_extend = torch.stack([RT[0], RT[1], RT[2], RT[3],
+                                 RT[4], RT[5], RT[6], RT[7],
+                                 RT[8], RT[3]/RT[4], RT[5]/RT[6],
+                                 RT[7]/RT[8]])
         return (RT_extend - self.X_min) / (self.X_max - self.X_min)
 
     @property
     def eta(self):
+        return self.Cached('eta', self.rt_, self._eta)
+
+    def _eta(self):
         # calculate eta
-        eta_n = self.eta_estimator(self.RTn_extend)
+        eta_n = self.Estimate('eta', self.RTn_extend)
         eta = eta_n * (self.Y_max - self.Y_min) + self.Y_min
         return eta
 
     @property
     def power(self):
+        return self.Cached('power', self.rt_, self._power)
+
+    def _power(self):
         # calculate power
-        power_n = self.power_estimator(self.RTn_extend)
+        power_n = self.Estimate('power', self.RTn_extend)
         power = power_n * (self.pow_Y_max - self.pow_Y_min) + self.pow_Y_min
         return power.mean()
 
-    def forward(self, z):
-        a = - (self.eta[0] + self.eta[1] * torch.tanh((z - self.eta[2]) * self.eta[3]))
+    def forward(self, z, eta=None):
+        # eta of shape [4, S, 1, 1] evaluates a stack of S circuits on z of shape [S, E, M]
+        if eta is None:
+            eta = self.eta
+        a = - (eta[0] + eta[1] * torch.tanh((z - eta[2]) * eta[3]))
         return a
     
     def UpdateArgs(self, args):
         self.args = args
+        self.ClearCache()
     
 
 # ================================================================================================================================================
 # ========================================================  Learnable Activation Circuit  ========================================================
 # ================================================================================================================================================
 
-class TanhRT(torch.nn.Module):
+class TanhRT(StepCache, SurrogateTable, torch.nn.Module):
+    circuit = 'tanh'
+
     def __init__(self, args):
         super().__init__()
         self.args = args
@@ -88,26 +191,9 @@ class TanhRT(torch.nn.Module):
         self.rt_ = torch.nn.Parameter(
             torch.tensor([args.ACT_R1n, args.ACT_R2n, args.ACT_W1n, args.ACT_L1n, args.ACT_W2n, args.ACT_L2n]), requires_grad=True)
 
-        # model
-        package = torch.load('./utils/act_model_package')
-        self.eta_estimator = package['eta_estimator'].to(self.DEVICE)
-        self.eta_estimator.train(False)
-        for n, p in self.eta_estimator.named_parameters():
-            p.requires_grad = False
-        self.X_max = package['X_max'].to(self.DEVICE)
-        self.X_min = package['X_min'].to(self.DEVICE)
-        self.Y_max = package['Y_max'].to(self.DEVICE)
-        self.Y_min = package['Y_min'].to(self.DEVICE)
-        # load power model
-        package = torch.load('./utils/act_power_model_package')
-        self.power_estimator = package['power_estimator'].to(self.DEVICE)
-        self.power_estimator.train(False)
-        for n, p in self.power_estimator.named_parameters():
-            p.requires_grad = False
-        self.pow_X_max = package['X_max'].to(self.DEVICE)
-        self.pow_X_min = package['X_min'].to(self.DEVICE)
-        self.pow_Y_max = package['Y_max'].to(self.DEVICE)
-        self.pow_Y_min = package['Y_min'].to(self.DEVICE)
+        # surrogate models
+        for name, value in LoadSurrogate(self.circuit, self.DEVICE).items():
+            setattr(self, name, value)
 
     @property
     def DEVICE(self):
@@ -115,6 +201,9 @@ class TanhRT(torch.nn.Module):
     
     @property
     def RT(self):
+        return self.Cached('RT', self.rt_, self._RT)
+
+    def _RT(self):
         # keep values in (0,1)
         rt_temp = torch.sigmoid(self.rt_)
         RTn = torch.zeros([9]).to(self.DEVICE)
@@ -126,29 +215,94 @@ class TanhRT(torch.nn.Module):
     
     @property
     def RTn_extend(self):
-        RT_extend = torch.stack([self.RT[0], self.RT[1], self.RT[2], self.RT[3],
-                                 self.RT[4], self.RT[5], self.RT[1]/self.RT[0],
-                                 self.RT[3]/self.RT[2], self.RT[5]/self.RT[4]])
+        return self.Cached('RTn_extend', self.rt_, self._RTn_extend)
+
+    def _RTn_extend(self):
+        RT = self.RT
+        RT_extend = torch.stack([RT[0], RT[1], RT[2], RT[3],
+                                 RT[4], RT[5], RT[1]/RT[0],
+                                 RT[3]/RT[2], RT[5]/RT[4]])
         return (RT_extend - self.X_min) / (self.X_max - self.X_min)
 
     @property
     def eta(self):
+        return self.Cached('eta', self.rt_, self._eta)
+
+    def _eta(self):
         # calculate eta
-        eta_n = self.eta_estimator(self.RTn_extend)
+        eta_n = self.Estimate('eta', self.RTn_extend)
         eta = eta_n * (self.Y_max - self.Y_min) + self.Y_min
         return eta
 
     @property
     def power(self):
+        return self.Cached('power', self.rt_, self._power)
+
+    def _power(self):
         # calculate power
-        power_n = self.power_estimator(self.RTn_extend)
+        power_n = self.Estimate('power', self.RTn_extend)
         power = power_n * (self.pow_Y_max - self.pow_Y_min) + self.pow_Y_min
         return power.mean()
 
-    def forward(self, z):
-        a = self.eta[0] + self.eta[1] * torch.tanh((z - self.eta[2]) * self.eta[3])
+    def forward(self, z, eta=None):
+        # eta of shape [4, S, 1, 1] evaluates a stack of S circuits on z of shape [S, E, M]
+        if eta is None:
+            eta = self.eta
+        a = eta[0] + eta[1] * torch.tanh((z - eta[2]) * eta[3])
         return a
     
     def UpdateArgs(self, args):
         self.args = args
-    
\ No newline at end of file
+        self.ClearCache()
+    
+
+# ================================================================================================================================================
+# ====================================================  Learnable Sigmoid Activation Circuit  ====================================================
+# ================================================================================================================================================
+
+class SigmoidRT(TanhRT):
+    circuit = 'sigmoid'
+
+    def __init__(self, args):
+        torch.nn.Module.__init__(self)
+        self.args = args
+        # R1n, R2n, W1n, L1n, W2n, L2n, initialized in the middle of the design space
+        self.rt_ = torch.nn.Parameter(torch.zeros([6]), requires_grad=True)
+
+        # surrogate models
+        for name, value in LoadSurrogate(self.circuit, self.DEVICE).items():
+            setattr(self, name, value)
+
+    def _RT(self):
+        # keep values in (0,1)
+        rt_temp = torch.sigmoid(self.rt_)
+        RTn = torch.zeros([8]).to(self.DEVICE)
+        RTn[:6] = rt_temp
+        # denormalization
+        RT = RTn * (self.X_max - self.X_min) + self.X_min
+        return RT
+
+    def _RTn_extend(self):
+        RT = self.RT
+        RT_extend = torch.stack([RT[0], RT[1], RT[2], RT[3],
+                                 RT[4], RT[5], RT[2]/RT[3],
+                                 RT[4]/RT[5]])
+        return (RT_extend - self.X_min) / (self.X_max - self.X_min)
+
+    def forward(self, z, eta=None):
+        # eta of shape [4, S, 1, 1] evaluates a stack of S circuits on z of shape [S, E, M]
+        if eta is None:
+            eta = self.eta
+        a = eta[0] + eta[1] * torch.sigmoid((z - eta[2]) * eta[3])
+        return a
+
+
+# activation circuits selectable by args.activation, the surrogates of 'hard_sigmoid' and 'relu' are in the registry,
+# their transfer functions are not modelled yet
+ACTIVATION_CIRCUITS = {'tanh': TanhRT, 'sigmoid': SigmoidRT}
+
+def ActivationCircuit(args):
+    name = getattr(args, 'activation', 'tanh')
+    if name not in ACTIVATION_CIRCUITS:
+        raise ValueError(f'unknown activation circuit: {name}')
+    return ACTIVATION_CIRCUITS[name](args)
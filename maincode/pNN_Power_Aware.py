@@ -1,11 +1,55 @@
 import numpy as np
 import torch
 from pLNC import *
+from utils.crossbar import *
+
+# ================================================================================================================================================
+# ===============================================================  Soft Counts  ==================================================================
+# ================================================================================================================================================
+
+class SoftCount(torch.autograd.Function):
+    # straight-through counts of the printed components of a crossbar theta [M+2, N]:
+    #   theta: nonzero weights
+    #   act:   activation circuits, columns with a nonzero weight of an input
+    #   neg:   inverters, inputs with a negative weight
+    # forward pass: the count, backward pass: gradient of the soft count (sigmoid of the weights, the maximum of each column / row)
+    @staticmethod
+    def forward(ctx, theta, mode):
+        rows = theta.shape[0] if mode == 'theta' else theta.shape[0] - 2
+        t = theta[:rows]
+        if mode == 'neg':
+            mask = (t < 0).to(t.dtype)
+            sigma = torch.sigmoid(t)
+            slope = - sigma * (1. - sigma) * mask
+            soft = (1. - sigma) * mask
+        else:
+            mask = (t != 0).to(t.dtype)
+            sigma = torch.sigmoid(t.abs())
+            slope = sigma * (1. - sigma) * torch.sign(t) * mask
+            soft = sigma * mask
+        if mode == 'theta':
+            N = mask.sum()
+        else:
+            dim = 0 if mode == 'act' else 1
+            N = mask.max(dim)[0].sum()
+            # only the maximal soft count of each column / row gets a gradient
+            select = torch.zeros_like(soft).scatter_(dim, soft.max(dim, keepdim=True)[1], 1.)
+            slope = slope * select
+        ctx.save_for_backward(slope)
+        ctx.shape = theta.shape
+        return N
+
+    @staticmethod
+    def backward(ctx, grad):
+        slope, = ctx.saved_tensors
+        grad_theta = torch.zeros(ctx.shape, dtype=slope.dtype, device=slope.device)
+        grad_theta[:slope.shape[0]] = grad * slope
+        return grad_theta, None
 
 # ================================================================================================================================================
 # ===============================================================  Printed Layer  ================================================================
 # ================================================================================================================================================
-class pLayer(torch.nn.Module):
+class pLayer(StepCache, torch.nn.Module):
     def __init__(self, n_in, n_out, args, ACT, INV):
         super().__init__()
         self.args = args
@@ -44,6 +88,8 @@ class pLayer(torch.nn.Module):
         temp_i = torch.sum(negative[:,:], axis = 1, keepdim = True)
         self.inv_mask[:n_in,:][temp_i[:n_in,:] == 0] = 0.
         self.pruned = True
+        # masks changed, derived conductances are outdated
+        self.ClearCache()
 
         num_t = torch.sum(self.theta_mask == 0).item()
         num_a = torch.sum(self.act_mask == 0).item()
@@ -61,6 +107,9 @@ class pLayer(torch.nn.Module):
 
     @property
     def theta_before_pruning(self):
+        return self.Cached('theta_before_pruning', self.theta_, self._theta_before_pruning)
+
+    def _theta_before_pruning(self):
         self.theta_.data.clamp_(-self.args.gmax, self.args.gmax)
         theta_temp = self.theta_.clone()
         theta_temp[theta_temp.abs() < self.args.gmin] = 0.
@@ -68,6 +117,9 @@ class pLayer(torch.nn.Module):
 
     @property
     def theta(self):
+        return self.Cached('theta', self.theta_, self._theta)
+
+    def _theta(self):
         # temp = self.theta_mask * (self.theta_before_pruning)
         temp = self.theta_before_pruning
         relu = torch.nn.ReLU()
@@ -75,21 +127,18 @@ class pLayer(torch.nn.Module):
 
     @property
     def W(self):
-        return self.theta.abs() / (torch.sum(self.theta.abs(), axis=0, keepdim=True) +  1e-10)
+        return self.Cached('W', self.theta_, self._W)
+
+    def _W(self):
+        theta_abs = self.theta.abs()
+        return theta_abs / (torch.sum(theta_abs, axis=0, keepdim=True) +  1e-10)
 
     def MAC(self, a):
-        positive = self.theta.clone().to(self.device)
-        positive[positive >= 0] = 1.
-        positive[positive < 0] = 0.
-        negative = 1. - positive
-        a_extend = torch.cat([a,
-                              torch.ones([a.shape[0], 1]).to(self.device),
-                              torch.zeros([a.shape[0], 1]).to(self.device)], dim=1)
+        positive, negative = SignMask(self.theta)
+        a_extend = ExtendInput(a)
         a_neg = self.INV(a_extend)
         a_neg[:, -1] = 0.
-        z = torch.matmul(a_extend, self.W * positive) + \
-            torch.matmul(a_neg, self.W * negative)
-        return z
+        return CrossbarMAC(a_extend, a_neg, self.W, positive, negative)
 
     def forward(self, a_previous):
         z_new = self.MAC(a_previous)
@@ -100,6 +149,9 @@ class pLayer(torch.nn.Module):
 
     @property
     def g_tilde(self):
+        return self.Cached('g_tilde', self.theta_, self._g_tilde)
+
+    def _g_tilde(self):
         # scaled conductances
         g_initial = self.theta_.abs()
         g_min = g_initial.min(dim=0, keepdim=True)[0]
@@ -107,6 +159,14 @@ class pLayer(torch.nn.Module):
         return g_initial * scaler
 
     def MACPower(self, x, y):
+        x_extend = ExtendInput(x)
+        x_neg = self.INV(x_extend)
+        x_neg[:, -1] = 0.
+        positive, negative = SignMask(self.theta.detach())
+        return CrossbarPower(x_extend, x_neg, y, self.g_tilde, positive, negative)
+
+    def MACPowerLoop(self, x, y):
+        # reference implementation of MACPower (one crossbar cell per iteration), kept for regression checks
         x_extend = torch.cat([x,
                               torch.ones([x.shape[0], 1]).to(self.device),
                               torch.zeros([x.shape[0], 1]).to(self.device)], dim=1)
@@ -154,50 +214,18 @@ class pLayer(torch.nn.Module):
 
     @property
     def soft_num_theta(self):
-        # forward pass: number of theta
-        nonzero = self.theta.clone().detach().abs()
-        nonzero[nonzero > 0] = 1.
-        N_theta = nonzero.sum()
-        # backward pass: pvalue of the minimal negative weights
-        soft_count = torch.sigmoid(self.theta.abs())
-        soft_count = soft_count * nonzero
-        soft_count = soft_count.sum()
-        if not self.pruned:
-            return N_theta.detach() + soft_count - soft_count.detach()
-        else:
-            return N_theta
+        # number of weights, straight-through gradient unless pruned
+        return SoftCount.apply(self.theta if not self.pruned else self.theta.detach(), 'theta')
 
     @property
     def soft_num_act(self):
-        # forward pass: number of act
-        nonzero = self.theta.clone().detach().abs()[:-2, :]
-        nonzero[nonzero > 0] = 1.
-        N_act = nonzero.max(0)[0].sum()
-        # backward pass: pvalue of the minimal negative weights
-        soft_count = torch.sigmoid(self.theta.abs()[:-2, :])
-        soft_count = soft_count * nonzero
-        soft_count = soft_count.max(0)[0].sum()
-        if not self.pruned:
-            return N_act.detach() + soft_count - soft_count.detach()
-        else:
-            return N_act
+        # number of activation circuits
+        return SoftCount.apply(self.theta if not self.pruned else self.theta.detach(), 'act')
 
     @property
     def soft_num_neg(self):
-        # forward pass: number of negative weights
-        positive = self.theta.clone().detach()[:-2, :]
-        positive[positive >= 0] = 1.
-        positive[positive < 0] = 0.
-        negative = 1. - positive
-        N_neg = negative.max(1)[0].sum()
-        # backward pass: pvalue of the minimal negative weights
-        soft_count = 1 - torch.sigmoid(self.theta[:-2, :])
-        soft_count = soft_count * negative
-        soft_count = soft_count.max(1)[0].sum()
-        if not self.pruned:
-            return N_neg.detach() + soft_count - soft_count.detach()
-        else:
-            return N_neg
+        # number of inverters
+        return SoftCount.apply(self.theta if not self.pruned else self.theta.detach(), 'neg')
     
     # @property
     # def power(self):
@@ -219,6 +247,141 @@ class pLayer(torch.nn.Module):
 
     def UpdateArgs(self, args):
         self.args = args
+        self.ClearCache()
+
+# ================================================================================================================================================
+# ==========================================================  Compacted Printed Layer  ============================================================
+# ================================================================================================================================================
+# a pruned pLayer rebuilt with its alive part only: the trainable crossbar keeps the inputs alive in the previous layer and the outputs
+# with act_mask 1, and inverters are only evaluated for inputs that can have negative weights.
+# the pruned cells still count in the normalization of W, in the MAC and in the power of the dense layer, they are frozen and enter as constants:
+#   - cells of dead inputs (x = 0, x_neg = INV(0)) in alive columns
+#   - dead columns, which only have bias weights and a constant output z that is masked by act_mask
+# so outputs and power are the same as of the dense layer, Expand() writes the trained part back into it
+
+class pCompactLayer(pLayer):
+    def __init__(self, layer, alive_in, full_output):
+        torch.nn.Module.__init__(self)
+        self.args = layer.args
+        self.INV = layer.INV
+        self.ACT = layer.ACT
+        self.nin = layer.nin
+        self.nout = layer.nout
+        self.pruned = True
+        self.full_output = full_output
+        # the dense layer is kept outside of the module tree, its parameter is not trained
+        self.__dict__['dense'] = layer
+
+        with torch.no_grad():
+            theta = layer.theta.detach().clone()
+            theta_raw = layer.theta_.detach().clone()
+        n_in = layer.nin
+        alive_out = torch.nonzero(layer.act_mask[0] == 1.).view(-1)
+        dead_out = torch.nonzero(layer.act_mask[0] == 0.).view(-1)
+        dead = torch.ones(n_in, dtype=torch.bool).to(alive_in.device)
+        dead[alive_in] = False
+        dead_in = torch.nonzero(dead).view(-1)
+        self.alive_in = alive_in
+        self.alive_out = alive_out
+        self.rows = torch.cat([alive_in, torch.tensor([n_in, n_in+1]).to(self.device)])
+
+        self.theta_ = torch.nn.Parameter(theta_raw[self.rows][:, alive_out].clone(), requires_grad=True)
+        self.inv_mask = layer.inv_mask[self.rows].clone()
+        # inputs that can have negative weights, the zero row has no inverter
+        self.neg_rows = torch.nonzero(self.inv_mask[:-1, 0] == 1.).view(-1)
+        self.constants = torch.tensor([0., 1.]).to(self.device)
+
+        # frozen cells of dead inputs in alive columns: [N_dead_in, N_alive_out]
+        theta_D = theta[dead_in][:, alive_out]
+        g_D = theta_raw[dead_in][:, alive_out].abs()
+        self.abs_D = theta_D.abs().sum(0, keepdim=True)
+        self.neg_D = (theta_D.abs() * (theta_D < 0)).sum(0, keepdim=True)
+        self.g_pos_D = (g_D * (theta_D >= 0)).sum(0)
+        self.g_neg_D = (g_D * (theta_D < 0)).sum(0)
+        self.g_min_D = g_D.min(0, keepdim=True)[0] if len(dead_in) else torch.full([1, len(alive_out)], float('inf')).to(self.device)
+        self.nonzero_D = (theta_D != 0).any(0)
+
+        # frozen dead columns: [N_in+2, N_dead_out]
+        theta_K = theta[:, dead_out]
+        W_K = theta_K.abs() / (torch.sum(theta_K.abs(), axis=0) + 1e-10)
+        g_K = theta_raw[:, dead_out].abs()
+        g_K = g_K * self.args.pgmin / g_K.min(0)[0]
+        self.W_pos_K = W_K[-2] * (theta_K[-2] >= 0)
+        self.W_neg_K = W_K[-2] * (theta_K[-2] < 0)
+        self.g_in_K = g_K[alive_in]
+        self.g_zero_K = g_K[dead_in].sum(0) + g_K[-1]
+        self.g_pos_K = g_K[-2] * (theta_K[-2] >= 0)
+        self.g_neg_K = g_K[-2] * (theta_K[-2] < 0)
+
+        self.N_theta_frozen = (theta_D != 0).sum() + (theta_K != 0).sum()
+        self.N_neg_frozen = (theta_D < 0).any(1).sum()
+
+    def _norm(self):
+        return torch.sum(self.theta.abs(), axis=0, keepdim=True) + self.abs_D + 1e-10
+
+    def _W(self):
+        return self.theta.abs() / self._norm()
+
+    def _g_tilde(self):
+        return self.theta_.abs() * self.g_scaler
+
+    @property
+    def g_scaler(self):
+        # the minimal conductance of a column includes the frozen cells
+        g_min = torch.minimum(self.theta_.abs().min(dim=0, keepdim=True)[0], self.g_min_D)
+        return self.args.pgmin / g_min
+
+    def forward(self, a_previous):
+        positive, negative = SignMask(self.theta)
+        a_extend = ExtendInput(a_previous)
+        a_neg = torch.zeros_like(a_extend)
+        a_neg[:, self.neg_rows] = self.INV(a_extend[:, self.neg_rows])
+        inv_0, inv_1 = self.INV(self.constants)
+
+        z = CrossbarMAC(a_extend, a_neg, self.W, positive, negative)
+        if len(self.alive_in) < self.nin:
+            z = z + self.neg_D * inv_0 / self._norm()
+        power = CrossbarPower(a_extend, a_neg, z, self.g_tilde, positive.detach(), negative.detach())
+
+        # frozen cells of dead inputs, with the same scaling of conductances as the column
+        if len(self.alive_in) < self.nin:
+            z_mean, z2_mean = z.mean(0), z.pow(2.).mean(0)
+            power = power + torch.sum(self.g_scaler[0] * (self.g_pos_D * z2_mean + self.g_neg_D * (inv_0**2 - 2*inv_0*z_mean + z2_mean)))
+
+        # dead columns, output z_K is constant
+        if len(self.alive_out) < self.nout:
+            z_K = self.W_pos_K + self.W_neg_K * inv_1
+            x_mean, x2_mean = a_previous.mean(0), a_previous.pow(2.).mean(0)
+            power = power + torch.sum(x2_mean @ self.g_in_K - 2 * z_K * (x_mean @ self.g_in_K) + z_K**2 * self.g_in_K.sum(0)
+                                      + self.g_zero_K * z_K**2 + self.g_pos_K * (1. - z_K)**2 + self.g_neg_K * (inv_1 - z_K)**2)
+        self.mac_power = power
+
+        a_new = self.ACT(z)
+        self.act_power = self.ACT.power * len(self.alive_out)
+        if self.full_output:
+            a_full = torch.zeros([a_new.shape[0], self.nout]).to(a_new.device)
+            a_full[:, self.alive_out] = a_new
+            return a_full
+        return a_new
+
+    @property
+    def soft_num_theta(self):
+        return (self.theta.detach() != 0).sum() + self.N_theta_frozen
+
+    @property
+    def soft_num_act(self):
+        return ((self.theta.detach()[:-2] != 0).any(0) | self.nonzero_D).sum()
+
+    @property
+    def soft_num_neg(self):
+        return (self.theta.detach()[:-2] < 0).any(1).sum() + self.N_neg_frozen
+
+    def Expand(self):
+        layer = self.__dict__['dense']
+        with torch.no_grad():
+            layer.theta_[self.rows.view(-1, 1), self.alive_out] = self.theta_
+        layer.ClearCache()
+        return layer
 
 
 # ================================================================================================================================================
@@ -230,7 +393,7 @@ class pNN(torch.nn.Module):
 
         self.args = args
         # define nonlinear circuits
-        self.act = TanhRT(args)
+        self.act = ActivationCircuit(args)
         self.inv = InvRT(args)
 
         self.model = torch.nn.Sequential()
@@ -239,8 +402,23 @@ class pNN(torch.nn.Module):
                 f'{i}-th pLayer', pLayer(topology[i], topology[i+1], args, self.act, self.inv))
 
     def forward(self, X):
+        # with args.compile the power of this forward pass is computed in the same compiled graph and kept for Power and PowerBreakdown
+        if getattr(self.args, 'compile', False):
+            if self.__dict__.get('compiled_forward_power') is None:
+                self.compiled_forward_power = CompiledFunction(ForwardPower)
+            self.compiled_forward_power.logger = getattr(self, 'msglogger', None)
+            prediction, self.compiled_power = self.compiled_forward_power(self, X)
+            return prediction
+        self.compiled_power = None
         return self.model(X)
     
+    def __getstate__(self):
+        # the compiled function, the message logger and the power of the last forward pass are transient and are neither saved nor copied
+        state = self.__dict__.copy()
+        for name in ['compiled_forward_power', 'msglogger', 'compiled_power']:
+            state.pop(name, None)
+        return state
+
     @property
     def pruning(self):
         result = (0,0,0,0,0,0)
@@ -249,6 +427,43 @@ class pNN(torch.nn.Module):
 
         return result[0], result[1], result[2], result[0]/result[3], result[1]/result[4], result[2]/result[5]
 
+    def Compact(self):
+        # after pruning: replace each layer by its compacted version, the names of the parameters stay the same
+        alive = torch.arange(self.model[0].nin).to(self.device)
+        names = list(self.model._modules.keys())
+        for i, name in enumerate(names):
+            layer = pCompactLayer(self.model._modules[name], alive, full_output=(i == len(names)-1))
+            self.model._modules[name] = layer
+            alive = layer.alive_out
+        return self
+
+    def Expand(self):
+        # back to the dense layers with the trained parameters, e.g. before saving
+        for name in list(self.model._modules.keys()):
+            if isinstance(self.model._modules[name], pCompactLayer):
+                self.model._modules[name] = self.model._modules[name].Expand()
+        return self
+
+    def Export(self, filename):
+        # frozen circuit for pNN_Runtime.py: eta of the nonlinear circuits, signed weights W, scaled conductances and masks as flat arrays,
+        # the power of inverters and activations does not depend on the input and is folded into one constant
+        layers = [l.Expand() if isinstance(l, pCompactLayer) else l for l in self.model]
+        bundle = {'N_layer': np.array(len(layers)), 'activation': np.array(self.act.circuit)}
+        with torch.no_grad():
+            bundle['eta_act'] = self.act.eta.cpu().numpy().astype(np.float32)
+            bundle['eta_inv'] = self.inv.eta.cpu().numpy().astype(np.float32)
+            power_static = self.inv.power * sum([l.soft_num_neg for l in layers]) + self.act.power * sum([l.soft_num_act for l in layers])
+            bundle['power_static'] = np.array(power_static.item())
+            for i, l in enumerate(layers):
+                positive, negative = SignMask(l.theta)
+                bundle[f'W_pos_{i}'] = (l.W * positive).cpu().numpy().astype(np.float32)
+                bundle[f'W_neg_{i}'] = (l.W * negative).cpu().numpy().astype(np.float32)
+                bundle[f'g_pos_{i}'] = (l.g_tilde * positive).cpu().numpy().astype(np.float64)
+                bundle[f'g_neg_{i}'] = (l.g_tilde * negative).cpu().numpy().astype(np.float64)
+                bundle[f'act_mask_{i}'] = l.act_mask.view(-1).cpu().numpy().astype(np.float32)
+        np.savez(filename, **bundle)
+        return filename
+
     @property
     def device(self):
         return self.args.DEVICE
@@ -295,8 +510,18 @@ class pNN(torch.nn.Module):
     
     @property
     def Power(self):
+        if getattr(self, 'compiled_power', None) is not None:
+            return self.compiled_power['total']
         return self.power_neg + self.power_act + self.power_mac
 
+    @property
+    def PowerBreakdown(self):
+        # all power components of the last forward pass, each evaluated once
+        if getattr(self, 'compiled_power', None) is not None:
+            return self.compiled_power
+        neg, act, mac = self.power_neg, self.power_act, self.power_mac
+        return {'neg': neg, 'act': act, 'mac': mac, 'total': neg + act + mac}
+
     def GetParam(self):
         weights = [p for name, p in self.named_parameters() if name.endswith('theta_') or name.endswith('beta')]
         nonlinear = [p for name, p in self.named_parameters() if name.endswith('rt_')]
@@ -313,6 +538,52 @@ class pNN(torch.nn.Module):
             if hasattr(layer, 'UpdateArgs'):
                 layer.UpdateArgs(args)
 
+def ForwardPower(pnn, X):
+    # forward pass and all power components of a pNN, traced as one graph by torch.compile
+    prediction = pnn.model(X)
+    neg, act, mac = pnn.power_neg, pnn.power_act, pnn.power_mac
+    return prediction, {'neg': neg, 'act': act, 'mac': mac, 'total': neg + act + mac}
+
+def CompileErrors():
+    # errors raised by dynamo and the compiler backends, errors of the traced function itself are not caught
+    try:
+        import torch._dynamo.exc as exc
+    except ImportError:
+        return ()
+    return tuple(getattr(exc, name) for name in ['BackendCompilerFailed', 'InternalTorchDynamoError', 'Unsupported'] if hasattr(exc, name))
+
+class CompiledFunction():
+    # torch.compile with static shapes (one graph per batch size), held by each pNN,
+    # falls back to the eager function if compilation is not available on this machine
+    def __init__(self, function, logger=None):
+        self.function = function
+        self.logger = logger
+        self.compiled = None
+        self.failed = False
+        self.errors = CompileErrors()
+
+    def Fallback(self, e):
+        msg = f'Compilation failed, fall back to eager execution: {e}'
+        if self.logger is not None:
+            self.logger.warning(msg)
+        else:
+            print(msg)
+        self.failed = True
+
+    def __call__(self, *args):
+        if self.compiled is None and not self.failed:
+            try:
+                self.compiled = torch.compile(self.function, dynamic=False)
+            except (AttributeError, RuntimeError) as e:
+                # torch.compile is missing or not supported by this python version
+                self.Fallback(e)
+        if not self.failed:
+            try:
+                return self.compiled(*args)
+            except self.errors as e:
+                self.Fallback(e)
+        return self.function(*args)
+
 # ================================================================================================================================================
 # ===============================================================  Loss function  ================================================================
 # ================================================================================================================================================
@@ -330,18 +601,25 @@ class Lossfunction(torch.nn.Module):
         _ = nn(x)
         return nn.Power
 
-    def constraint(self, nn):
-        return nn.Power - self.args.POWER
+    def constraint(self, nn, power=None):
+        if power is None:
+            power = nn.Power
+        return power - self.args.POWER
     
-    def psi(self, nn):
-        if self.args.lambda_ + self.args.mu * self.constraint(nn) >= 0:
-            return (self.args.lambda_ * self.constraint(nn)) + (self.args.mu/2) * (self.constraint(nn) ** 2)
+    def psi(self, nn, power=None):
+        C = self.constraint(nn, power)
+        if self.args.lambda_ + self.args.mu * C >= 0:
+            return (self.args.lambda_ * C) + (self.args.mu/2) * (C ** 2)
         else:
             return -(self.args.lambda_ ** 2) / (2 * self.args.mu)
 
-    def forward(self, nn, x, label):
+    def objective(self, prediction, label, power):
+        # loss from the output and power of a single forward pass
         if self.args.powerestimator == 'power':
-            return (1. - self.args.powerbalance) * self.standard(nn(x), label) + self.args.powerbalance * self.PowerEstimator(nn, x) * 100
+            return (1. - self.args.powerbalance) * self.standard(prediction, label) + self.args.powerbalance * power * 100
         elif self.args.powerestimator == 'AL':
-            _ = nn(x)
-            return self.standard(nn(x), label) + self.psi(nn)
+            return self.standard(prediction, label) + self.psi(None, power)
+
+    def forward(self, nn, x, label):
+        prediction = nn(x)
+        return self.objective(prediction, label, nn.Power)
@@ -0,0 +1,89 @@
+import numpy as np
+
+# ================================================================================================================================================
+# ===========================================================  NumPy Runtime of pNN  =============================================================
+# ================================================================================================================================================
+# evaluation of a trained pNN without torch and without the surrogate models, from the arrays written by pNN.Export, e.g.
+#   pnn = torch.load('pNN_{setup}_FT.model'); pnn.Export('pNN_{setup}_FT.npz')
+#   runtime = pNNRuntime('pNN_{setup}_FT.npz'); prediction, power = runtime(X, power=True)
+# outputs and power follow pNN.forward and pNN.Power for the frozen circuit
+
+def TanhRT(z, eta):
+    return eta[0] + eta[1] * np.tanh((z - eta[2]) * eta[3])
+
+def SigmoidRT(z, eta):
+    return eta[0] + eta[1] / (1. + np.exp(- (z - eta[2]) * eta[3]))
+
+ACTIVATION_CIRCUITS = {'tanh': TanhRT, 'sigmoid': SigmoidRT}
+
+def InvRT(z, eta):
+    return - (eta[0] + eta[1] * np.tanh((z - eta[2]) * eta[3]))
+
+def CrossbarPower(x, y, g):
+    # sum of g * (x - y)^2 over all crossbar cells, averaged over samples, expanded such that no [E, M, N] tensor is built
+    E = x.shape[0]
+    x2 = (x * x).sum(axis=0)
+    y2 = (y * y).sum(axis=0)
+    return (x2 @ g.sum(axis=1) - 2. * np.sum(g * (x.T @ y)) + g.sum(axis=0) @ y2) / E
+
+
+class pLayerRuntime():
+    def __init__(self, bundle, i):
+        W_pos, W_neg = bundle[f'W_pos_{i}'], bundle[f'W_neg_{i}']
+        g_pos, g_neg = bundle[f'g_pos_{i}'], bundle[f'g_neg_{i}']
+        self.act_mask = bundle[f'act_mask_{i}']
+        # inverters are only evaluated for inputs with negative weights, the zero row has neither input nor inverter
+        self.neg_rows = np.nonzero(np.any(W_neg[:-2] != 0, axis=1))[0]
+        self.W_pos = W_pos[:-2]
+        self.W_neg = W_neg[:-2][self.neg_rows]
+        self.g_in_pos = g_pos[:-2]
+        self.g_in_neg = g_neg[:-2][self.neg_rows]
+        self.g_bias_pos, self.g_bias_neg, self.g_zero = g_pos[-2], g_neg[-2], g_pos[-1] + g_neg[-1]
+        self.W_bias_pos, self.W_bias_neg = W_pos[-2], W_neg[-2]
+
+    def forward(self, a, act, eta_act, eta_inv, power):
+        a_neg = InvRT(a[:, self.neg_rows], eta_inv)
+        inv_1 = InvRT(np.float32(1.), eta_inv)
+        z = a @ self.W_pos + a_neg @ self.W_neg + (self.W_bias_pos + self.W_bias_neg * inv_1)
+        mac_power = None
+        if power:
+            z_ = z.astype(np.float64)
+            mac_power = CrossbarPower(a.astype(np.float64), z_, self.g_in_pos) + CrossbarPower(a_neg.astype(np.float64), z_, self.g_in_neg) \
+                      + np.mean(self.g_bias_pos * (1. - z_)**2 + self.g_bias_neg * (inv_1 - z_)**2 + self.g_zero * z_**2, axis=0).sum()
+        return act(z, eta_act) * self.act_mask, mac_power
+
+
+class pNNRuntime():
+    def __init__(self, filename):
+        bundle = np.load(filename)
+        # bundles exported before the activation was selectable are tanh circuits
+        self.act = ACTIVATION_CIRCUITS[str(bundle['activation']) if 'activation' in bundle else 'tanh']
+        self.eta_act = bundle['eta_act']
+        self.eta_inv = bundle['eta_inv']
+        self.power_static = float(bundle['power_static'])
+        self.model = [pLayerRuntime(bundle, i) for i in range(int(bundle['N_layer']))]
+
+    def forward(self, X, power=False):
+        # X: [E, N_feature] -> [E, N_class], and the power of the circuit for this batch if power is set
+        a = np.asarray(X, dtype=np.float32)
+        P = self.power_static
+        for layer in self.model:
+            a, mac_power = layer.forward(a, self.act, self.eta_act, self.eta_inv, power)
+            if power:
+                P += mac_power
+        return (a, P) if power else a
+
+    def __call__(self, X, power=False):
+        return self.forward(X, power)
+
+    def Evaluate(self, X, y, metric='acc', sensing_margin=0.01):
+        # accuracy or measuring-aware accuracy as in utils.Evaluator, and power
+        prediction, power = self.forward(X, power=True)
+        y = np.asarray(y).reshape(-1)
+        if metric == 'acc':
+            corrects = prediction.argmax(axis=1) == y
+        else:
+            top = np.argsort(-prediction, axis=1, kind='stable')[:, :2]
+            act = np.take_along_axis(prediction, top, axis=1)
+            corrects = (act[:, 0] >= sensing_margin) & (act[:, 1] <= 0) & (top[:, 0] == y)
+        return corrects.mean(), power
@@ -0,0 +1,108 @@
+import os
+import sys
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), 'utils'))
+from configuration import *
+import time
+import queue
+import shutil
+import argparse
+import itertools
+import subprocess
+import concurrent.futures
+from utils import *
+
+# runs a sweep (datasets x seeds x power targets x estimators) of experiment.py on a local worker pool,
+# every worker gets its own set of cores and the intra-op threads of torch are limited to it,
+# arguments that are not listed below are passed to every experiment, e.g.
+#   python scheduler.py --DATASETS 0 1 2 --SEEDS 0 1 --POWERS 200 400 --WORKERS 8 --THREADS 2 --projectname PowerAwareAugmentedLagrangian
+
+sweep = argparse.ArgumentParser(prog = 'Scheduler',
+                                description = 'Local worker pool for sweeps of experiment.py',
+                                allow_abbrev = False)
+
+sweep.add_argument('--DATASETS',              type=int,       default=list(range(13)), nargs='+', help='indices of datasets')
+sweep.add_argument('--SEEDS',                 type=int,       default=list(range(10)), nargs='+', help='random seeds')
+sweep.add_argument('--ESTIMATORS',            type=str,       default=['AL'], nargs='+',          help='power estimators: AL, power')
+sweep.add_argument('--POWERS',                type=float,     default=[500.], nargs='+',          help='power targets (in uW) of AL experiments')
+sweep.add_argument('--BALANCES',              type=float,     default=[0.8], nargs='+',           help='powerbalance of power experiments')
+sweep.add_argument('--WORKERS',               type=int,       default=0,                          help='number of parallel experiments, 0 for (number of cores) / THREADS')
+sweep.add_argument('--THREADS',               type=int,       default=1,                          help='intra-op threads per experiment')
+sweep.add_argument('--PINNING',               type=str2bool,  default=True,                       help='pin every worker to its own cores')
+sweep.add_argument('--script',                type=str,       default='experiment.py',            help='experiment script to run')
+
+
+def Setup(argv):
+    # setup name as formed by experiment.py
+    args = parser.parse_args(argv)
+    if args.powerestimator == 'AL':
+        args.powerbalance = args.POWER
+    _, datainfo = GetDataLoader(args, 'train')
+    return f"data_{datainfo['dataname']}_seed_{args.SEED}_Penalty_{args.powerestimator}_Factor_{int(args.powerbalance):04d}", args
+
+
+def Jobs(config, passthrough):
+    jobs = []
+    for estimator in config.ESTIMATORS:
+        targets = config.POWERS if estimator == 'AL' else config.BALANCES
+        option = '--POWER' if estimator == 'AL' else '--powerbalance'
+        for dataset, target, seed in itertools.product(config.DATASETS, targets, config.SEEDS):
+            argv = ['--DATASET', str(dataset), '--SEED', str(seed), '--powerestimator', estimator, option, f'{target:g}'] + passthrough
+            setup, args = Setup(argv)
+            MakeFolder(args)
+            # finished experiments are skipped, interrupted ones are resumed by experiment.py from the .model and .ckp files
+            if os.path.isfile(f'{args.savepath}/pNN_{setup}_FT.model'):
+                print(f'{setup}_FT exists, skip this training.')
+                continue
+            jobs.append((setup, argv, args))
+    return jobs
+
+
+def Run(job, cores, config):
+    setup, argv, args = job
+    core = cores.get()
+    env = dict(os.environ)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        env[var] = str(config.THREADS)
+    # pinned by taskset, as preexec_fn is not safe in the threads of the worker pool
+    pinning = ['taskset', '-c', ','.join([str(c) for c in sorted(core)])] if config.PINNING else []
+    try:
+        with open(f'{args.logfilepath}/{setup}.out', 'a') as out:
+            process = subprocess.run(pinning + [sys.executable, config.script] + argv, env=env, stdout=out, stderr=subprocess.STDOUT)
+    finally:
+        cores.put(core)
+    return setup, process.returncode
+
+
+if __name__ == '__main__':
+    config, passthrough = sweep.parse_known_args()
+
+    available = sorted(os.sched_getaffinity(0))
+    if config.PINNING and shutil.which('taskset') is None:
+        print('taskset is not available, workers are not pinned.')
+        config.PINNING = False
+    if not config.WORKERS:
+        config.WORKERS = max(1, len(available) // config.THREADS)
+    # disjoint core sets for the workers, shared round-robin if there are more threads than cores
+    cores = queue.Queue()
+    for w in range(config.WORKERS):
+        cores.put({available[(w * config.THREADS + t) % len(available)] for t in range(config.THREADS)})
+
+    jobs = Jobs(config, passthrough)
+    print(f'{len(jobs)} experiments on {config.WORKERS} workers with {config.THREADS} threads each.')
+
+    start_time = time.time()
+    N_finished = 0
+    N_failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.WORKERS) as pool:
+        futures = [pool.submit(Run, job, cores, config) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            setup, returncode = future.result()
+            if returncode:
+                N_failed += 1
+                print(f'{setup} failed with exit code {returncode}.')
+            else:
+                N_finished += 1
+            hours = (time.time() - start_time) / 3600
+            print(f'| Finished: {N_finished:-5d} | Failed: {N_failed:-5d} | Remaining: {len(jobs)-N_finished-N_failed:-5d} |'\
+                  f' Elapsed: {hours:.2f} h | Throughput: {N_finished/hours:.1f} experiments/h | {setup}')
@@ -0,0 +1,103 @@
+import os
+import sys
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import pytest
+import torch
+from configuration import parser
+import pNN_Power_Aware as pNN
+
+# regression checks of the crossbar power and of the hand-written backward passes, run by pytest or by python test_power.py
+
+@pytest.fixture(autouse=True)
+def maincode(monkeypatch):
+    # the surrogate packages are loaded relative to maincode, only for the tests of this file
+    monkeypatch.chdir(HERE)
+
+def RandomLayer(n_in, n_out, seed, pruned=False):
+    torch.manual_seed(seed)
+    args = parser.parse_args([])
+    layer = pNN.pNN([n_in, n_out], args).model[0]
+    with torch.no_grad():
+        # random signs, such that negative weights and inverters are used
+        layer.theta_.data = (torch.rand(layer.theta_.shape) * 2. - 1.) * 2.
+        # a column with negative weights only
+        layer.theta_.data[:n_in, 0] = - layer.theta_.data[:n_in, 0].abs() - args.gmin
+    layer.ClearCache()
+    if pruned:
+        with torch.no_grad():
+            # weights below gmin are pruned, one column completely
+            layer.theta_.data[:, -1] = args.gmin / 2.
+            layer.theta_.data[0, :] = args.gmin / 2.
+        layer.ClearCache()
+        layer.pruning_
+    return layer
+
+def Gradients(layer, function, x):
+    layer.ClearCache()
+    layer.INV.ClearCache()
+    z = layer.MAC(x)
+    power = function(x, z)
+    parameters = [layer.theta_, layer.INV.rt_]
+    return power, torch.autograd.grad(power, parameters, allow_unused=True)
+
+def CompareMACPower(n_in, n_out, seed, pruned):
+    layer = RandomLayer(n_in, n_out, seed, pruned)
+    x = torch.rand([32, n_in])
+    power, grads = Gradients(layer, layer.MACPower, x)
+    power_loop, grads_loop = Gradients(layer, layer.MACPowerLoop, x)
+    assert torch.allclose(power, power_loop, rtol=1e-5, atol=1e-12), (power, power_loop)
+    for g, g_loop in zip(grads, grads_loop):
+        assert (g is None) == (g_loop is None)
+        if g is not None:
+            assert torch.allclose(g, g_loop, rtol=1e-4, atol=1e-10), (g - g_loop).abs().max()
+
+def test_macpower_matches_loop():
+    for seed, (n_in, n_out) in enumerate([(4, 3), (16, 12), (7, 1)]):
+        CompareMACPower(n_in, n_out, seed, pruned=False)
+
+def test_macpower_matches_loop_pruned():
+    for seed, (n_in, n_out) in enumerate([(4, 3), (16, 12)]):
+        CompareMACPower(n_in, n_out, seed, pruned=True)
+
+def test_crossbar_power_gradcheck():
+    torch.manual_seed(0)
+    for shape in [(), (3,)]:
+        E, M, N = 5, 4, 3
+        x_extend = torch.rand([*shape, E, M], dtype=torch.float64, requires_grad=True)
+        x_neg = torch.rand([*shape, E, M], dtype=torch.float64, requires_grad=True)
+        y = torch.rand([*shape, E, N], dtype=torch.float64, requires_grad=True)
+        g_tilde = torch.rand([*shape, M, N], dtype=torch.float64, requires_grad=True)
+        positive, negative = pNN.SignMask(torch.randn([*shape, M, N], dtype=torch.float64))
+        assert torch.autograd.gradcheck(lambda *inputs: pNN.CrossbarPowerFunction.apply(*inputs, positive, negative), (x_extend, x_neg, y, g_tilde))
+
+def SoftReference(theta, mode):
+    # the soft count whose gradient is the backward pass of SoftCount
+    rows = theta.shape[0] if mode == 'theta' else theta.shape[0] - 2
+    t = theta[:rows]
+    if mode == 'neg':
+        soft = (1. - torch.sigmoid(t)) * (t < 0).to(t.dtype)
+        return soft.max(1)[0].sum()
+    soft = torch.sigmoid(t.abs()) * (t != 0).to(t.dtype)
+    return soft.sum() if mode == 'theta' else soft.max(0)[0].sum()
+
+def test_softcount_gradcheck():
+    torch.manual_seed(0)
+    # weights away from 0, where the counts are locally constant, an input without negative weights
+    theta = torch.randn([6, 4], dtype=torch.float64)
+    theta = theta + 0.5 * torch.sign(theta)
+    theta[0, :] = theta[0, :].abs()
+    theta.requires_grad_(True)
+    for mode in ['theta', 'act', 'neg']:
+        # the count plus its (constant) difference to the soft count: the numerical gradient is the one of the soft count,
+        # the analytical one is the backward pass of SoftCount
+        function = lambda t: pNN.SoftCount.apply(t, mode) + (SoftReference(t, mode) - pNN.SoftCount.apply(t, mode)).detach()
+        assert torch.autograd.gradcheck(function, (theta,)), mode
+
+if __name__ == '__main__':
+    os.chdir(HERE)
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(f'{name} passed')
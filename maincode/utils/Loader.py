@@ -1,11 +1,123 @@
 import os
+import json
+import fcntl
+import shutil
 import pickle
+import tempfile
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SequentialSampler
 import sys
 sys.path.append(os.path.join(os.getcwd()))
 sys.path.append('../')
 
+# ================================================================================================================================================
+# ==========================================================  Memory-mapped Data Cache  ==========================================================
+# ================================================================================================================================================
+
+# datasets opened in this process, shared by all splits and loaders
+DATA_CACHE = {}
+
+def CachePath(datapath):
+    return os.path.splitext(datapath)[0] + '.cache'
+
+def ReadMeta(datapath):
+    # meta data of a valid cache of the dataset, None if the cache is missing or older than the dataset
+    metapath = os.path.join(CachePath(datapath), 'meta.json')
+    try:
+        with open(metapath, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta['source_mtime'] != os.path.getmtime(datapath):
+        return None
+    return meta
+
+def ConvertDataset(datapath):
+    # one-time conversion of a pickled dataset into a folder with one .npy file per tensor and a json file for the rest
+    # concurrent processes convert one after another (lock file next to the cache), a valid cache written by another process is kept,
+    # only a stale cache is replaced
+    cachepath = CachePath(datapath)
+    with open(cachepath + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if ReadMeta(datapath) is not None:
+                return cachepath
+            with open(datapath, 'rb') as f:
+                data = pickle.load(f)
+            # write into a temporary folder and rename it, so readers never see a partial cache
+            tmppath = tempfile.mkdtemp(dir=os.path.dirname(cachepath), prefix='.tmp_')
+            try:
+                meta = {'arrays': [], 'source_mtime': os.path.getmtime(datapath)}
+                for key, value in data.items():
+                    if torch.is_tensor(value):
+                        np.save(os.path.join(tmppath, f'{key}.npy'), value.numpy())
+                        meta['arrays'].append(key)
+                    else:
+                        meta[key] = value
+                with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+                    json.dump(meta, f)
+            except BaseException:
+                shutil.rmtree(tmppath, ignore_errors=True)
+                raise
+            # the stale cache is moved aside before it is deleted, arrays mapped by other processes stay readable
+            stalepath = None
+            if os.path.isdir(cachepath):
+                stalepath = tempfile.mkdtemp(dir=os.path.dirname(cachepath), prefix='.stale_')
+                os.rename(cachepath, os.path.join(stalepath, 'cache'))
+            os.rename(tmppath, cachepath)
+            if stalepath is not None:
+                shutil.rmtree(stalepath, ignore_errors=True)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return cachepath
+
+def LoadPickled(datapath):
+    # the dataset in memory of this process, if no cache can be written next to it
+    with open(datapath, 'rb') as f:
+        return pickle.load(f)
+
+def ConvertAll(path):
+    for f in sorted(os.listdir(path)):
+        if f.startswith('Dataset') and f.endswith('.p'):
+            ConvertDataset(os.path.join(path, f))
+
+def LoadDataset(datapath, retries=3):
+    # open a dataset from its memory-mapped cache (converted on first use)
+    # tensors share the page cache with every other process reading the same dataset,
+    # the mapping is copy-on-write, so in-place changes stay private to the process,
+    # a dataset in a folder without write access is loaded into memory instead
+    datapath = os.path.abspath(datapath)
+    if datapath in DATA_CACHE:
+        return DATA_CACHE[datapath]
+    cachepath = CachePath(datapath)
+    for attempt in range(retries):
+        meta = ReadMeta(datapath)
+        if meta is None:
+            if not os.access(os.path.dirname(cachepath), os.W_OK):
+                data = LoadPickled(datapath)
+                break
+            try:
+                ConvertDataset(datapath)
+            except PermissionError:
+                data = LoadPickled(datapath)
+                break
+            meta = ReadMeta(datapath)
+        try:
+            if meta is None:
+                raise FileNotFoundError(f'no valid cache of {datapath}')
+            data = {k: v for k, v in meta.items() if k not in ['arrays', 'source_mtime']}
+            for key in meta['arrays']:
+                data[key] = torch.from_numpy(np.load(os.path.join(cachepath, f'{key}.npy'), mmap_mode='c'))
+            break
+        except FileNotFoundError:
+            # the cache was replaced by another process in the meantime, check again
+            if attempt == retries - 1:
+                raise
+    DATA_CACHE[datapath] = data
+    return data
+
+
 class dataset(Dataset):
     def __init__(self, dataset, args, datapath, mode='train'):
         self.args = args
@@ -14,8 +126,7 @@ class dataset(Dataset):
             datapath = os.path.join(args.DataPath, dataset)
         else:
             datapath = os.path.join(datapath, dataset)
-        with open(datapath, 'rb') as f:
-            data = pickle.load(f)
+        data = LoadDataset(datapath)
         
         X_train         = data['X_train']
         y_train         = data['y_train']
@@ -24,15 +135,17 @@ class dataset(Dataset):
         X_test          = data['X_test']
         y_test          = data['y_test']
         
+        # the R noisy views of each split are virtual: only the base tensors are kept,
+        # the i-th sample of the replicated split is a noisy view of the (i mod N)-th base sample
         if mode == 'train':
-            self.X_train    = torch.cat([X_train for _ in range(args.R_train)], dim=0).to(args.DEVICE)
-            self.y_train    = torch.cat([y_train for _ in range(args.R_train)], dim=0).to(args.DEVICE)
+            self.X_train    = X_train.to(args.DEVICE)
+            self.y_train    = y_train.to(args.DEVICE)
         elif mode == 'valid':
-            self.X_valid    = torch.cat([X_valid for _ in range(args.R_train)], dim=0).to(args.DEVICE)
-            self.y_valid    = torch.cat([y_valid for _ in range(args.R_train)], dim=0).to(args.DEVICE)
+            self.X_valid    = X_valid.to(args.DEVICE)
+            self.y_valid    = y_valid.to(args.DEVICE)
         elif mode == 'test':
-            self.X_test    = torch.cat([X_test for _ in range(args.R_test)], dim=0).to(args.DEVICE)
-            self.y_test    = torch.cat([y_test for _ in range(args.R_test)], dim=0).to(args.DEVICE)
+            self.X_test    = X_test.to(args.DEVICE)
+            self.y_test    = y_test.to(args.DEVICE)
         
         self.data_name  = data['name']
         self.N_class    = data['n_class']
@@ -42,33 +155,43 @@ class dataset(Dataset):
         self.N_test     = X_test.shape[0]
 
         self.mode = mode
+        # random generator of the input noise, None for the global one (see SeededLoader)
+        self.generator = None
         
 
+    def AddNoise(self, X, noise_level):
+        noise = torch.randn(X.shape, generator=self.generator) * noise_level + 1.
+        return X * noise.to(self.args.DEVICE)
+
+    # the noisy_X_* properties materialize all R noisy views of a split
     @property
     def noisy_X_train(self):
-        noise = torch.randn(self.X_train.shape) * self.args.InputNoise + 1.
-        return self.X_train * noise.to(self.args.DEVICE)
+        return self.AddNoise(self.X_train.repeat(self.args.R_train, 1), self.args.InputNoise)
 
     @property
     def noisy_X_valid(self):
-        noise = torch.randn(self.X_valid.shape) * self.args.InputNoise +1.
-        return self.X_valid * noise.to(self.args.DEVICE)
+        return self.AddNoise(self.X_valid.repeat(self.args.R_train, 1), self.args.InputNoise)
     
     @property
     def noisy_X_test(self):
-        noise = torch.randn(self.X_test.shape) * self.args.IN_test + 1.
-        return self.X_test * noise.to(self.args.DEVICE)
+        return self.AddNoise(self.X_test.repeat(self.args.R_test, 1), self.args.IN_test)
     
     
     def __getitem__(self, index):
+        # index can be a single sample or a whole batch of samples (see BatchLoader)
+        # noise is only drawn for the selected samples
+        index = torch.as_tensor(index)
         if self.mode == 'train':
-            x = self.noisy_X_train[index,:]
+            index = index % self.N_train
+            x = self.AddNoise(self.X_train[index], self.args.InputNoise)
             y = self.y_train[index]
         elif self.mode == 'valid':
-            x = self.noisy_X_valid[index,:]
+            index = index % self.N_valid
+            x = self.AddNoise(self.X_valid[index], self.args.InputNoise)
             y = self.y_valid[index]
         elif self.mode == 'test':
-            x = self.noisy_X_test[index,:]
+            index = index % self.N_test
+            x = self.AddNoise(self.X_test[index], self.args.IN_test)
             y = self.y_test[index]
         return x, y
     
@@ -80,6 +203,41 @@ class dataset(Dataset):
         elif self.mode == 'test':
             return self.N_test * self.args.R_test
         
+
+
+def BatchLoader(data, batch_size=None):
+    # the sampler yields the indices of a whole batch, which are fetched from the dataset in one call,
+    # thus noise is drawn once per batch and no per-sample collation is needed
+    # batch_size bounds the number of noisy samples materialized at once, None or 0 for a single full batch
+    if not batch_size:
+        batch_size = len(data)
+    sampler = BatchSampler(SequentialSampler(data), batch_size=batch_size, drop_last=False)
+    return DataLoader(data, sampler=sampler, batch_size=None)
+
+
+class SeededLoader():
+    # batches of a loader with the input noise drawn from an own generator, e.g. one per seed in lockstep training,
+    # the generator is only set while a batch is fetched, such that several loaders of the same dataset can be iterated alternately
+    def __init__(self, loader, generator):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.generator = generator
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        while True:
+            self.dataset.generator = self.generator
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.dataset.generator = None
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
         
 def GetDataLoader(args, mode, path=None):
     normal_datasets = ['Dataset_acuteinflammation.p',
@@ -147,9 +305,9 @@ def GetDataLoader(args, mode, path=None):
         testset   = dataset(dataname, args, path, mode='test')
 
         # batch
-        train_loader = DataLoader(trainset, batch_size=len(trainset))
-        valid_loader = DataLoader(validset, batch_size=len(validset))
-        test_loader  = DataLoader(testset,  batch_size=len(testset))
+        train_loader = BatchLoader(trainset, args.MAX_BATCH)
+        valid_loader = BatchLoader(validset, args.MAX_BATCH)
+        test_loader  = BatchLoader(testset, args.MAX_BATCH)
         
         # message
         info = {}
@@ -174,13 +332,13 @@ def GetDataLoader(args, mode, path=None):
         infos = []
         for dataname in split_manufacture:
             # data
-            trainset  = dataset(dataname, args, mode='train')
-            validset  = dataset(dataname, args, mode='valid')
-            testset   = dataset(dataname, args, mode='test')
+            trainset  = dataset(dataname, args, path, mode='train')
+            validset  = dataset(dataname, args, path, mode='valid')
+            testset   = dataset(dataname, args, path, mode='test')
             # batch
-            train_loaders.append(DataLoader(trainset, batch_size=len(trainset)))
-            valid_loaders.append(DataLoader(validset, batch_size=len(validset)))
-            test_loaders.append(DataLoader(testset,  batch_size=len(testset)))
+            train_loaders.append(BatchLoader(trainset, args.MAX_BATCH))
+            valid_loaders.append(BatchLoader(validset, args.MAX_BATCH))
+            test_loaders.append(BatchLoader(testset, args.MAX_BATCH))
             # message
             info = {}
             info['dataname'] = trainset.data_name
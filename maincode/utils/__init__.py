@@ -2,8 +2,12 @@ import torch
 import numpy as np
 import random
 import os
+from .crossbar import *
 from .training import *
+from .training_lockstep import *
 from .evaluation import *
+from .montecarlo import *
+from .results import *
 from .logger import *
 from .Loader import *
 
@@ -35,6 +39,7 @@ def MakeFolder(args):
         args.logfilepath = f'./{args.projectname}/log/'
         args.recordpath = f'./{args.projectname}/record/'
         args.savepath = f'./{args.projectname}/models/'
+        args.resultfile = f'./{args.projectname}/results.jsonl'
     
     if not os.path.exists(args.temppath):
         os.makedirs(args.temppath)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 class Aging_model_generator():
     def __init__(self, dists_linear, param_data_approx):
@@ -8,6 +9,10 @@ class Aging_model_generator():
     def _get_param_sample(self):
         ''' samples from the param distributions '''
         return np.array([self.dist[c].rvs(1, np.random.randint(0,10000))*self.param_data[:,c].std().numpy() for c in range(self.param_data.shape[1])]).ravel()
+
+    def _get_param_samples(self, number_of_models=1, random_state=None):
+        ''' samples [number_of_models, n_params] from the param distributions, one draw per distribution '''
+        return np.stack([self.dist[c].rvs(size=number_of_models, random_state=random_state)*self.param_data[:,c].std().numpy() for c in range(self.param_data.shape[1])], axis=1)
     
     @staticmethod
     def transform_sample(x):
@@ -21,6 +26,21 @@ class Aging_model_generator():
         generate number_of_models pairs of parameters for function
         '''
         pass
+
+    def get_params(self, number_of_models=1, random_state=None):
+        '''
+        parameters [number_of_models, n_params] of number_of_models functions
+        '''
+        return self.transform_samples(self._get_param_samples(number_of_models, random_state))
+
+    def get_aging_factors(self, number_of_models, t, random_state=None):
+        '''
+        aging factors [number_of_models, len(t)] of number_of_models sampled functions at the time points t,
+        as a tensor of the default dtype to scale the conductances of pLayer,
+        random_state (e.g. a numpy Generator) makes the draw reproducible, by default the global numpy state is used
+        '''
+        factors = self.evaluate(self.get_params(number_of_models, random_state), np.asarray(t, dtype=float))
+        return torch.from_numpy(factors).to(torch.get_default_dtype())
     
 class Linear_aging_model_sampler(Aging_model_generator):
     def get_models(self, number_of_models=1):
@@ -30,6 +50,15 @@ class Linear_aging_model_sampler(Aging_model_generator):
     def transform_sample(x):
         ''' negates first entries '''
         return np.r_[-x[:-1], x[-1]]
+
+    @staticmethod
+    def transform_samples(x):
+        ''' negates first entries of each row '''
+        return np.c_[-x[:, :-1], x[:, -1]]
+
+    @staticmethod
+    def evaluate(params, x):
+        return PiecewiseLinear.evaluate(params, x)
     
 class Exp_aging_model_sampler(Aging_model_generator):
     def get_models(self, number_of_models=1):
@@ -40,19 +69,35 @@ class Exp_aging_model_sampler(Aging_model_generator):
         ''' negates first entries '''
         return np.r_[x[0], -x[1]]
 
+    @staticmethod
+    def transform_samples(x):
+        ''' negates second entry of each row '''
+        return np.c_[x[:, 0], -x[:, 1]]
+
+    @staticmethod
+    def evaluate(params, x):
+        return ExponentialFunction.evaluate(params, x)
+
 
 class PiecewiseLinear:
     def __init__(self, params):
         self.params = params 
     def __call__(self, x):
-        m0, m1, b1 = self.params
+        return self.evaluate(np.asarray(self.params)[None, :], np.asarray(x, dtype=float))[0]
+    @staticmethod
+    def evaluate(params, x):
+        ''' params [M, 3], time points [K] -> [M, K] '''
+        m0, m1, b1 = [p[:, None] for p in params.T]
         b0 = 1
-        mod = lambda z : max(z*m0 + b0, z*m1 + b1)
-        return np.array([mod(xi) for xi in x])
+        return np.maximum(x[None, :]*m0 + b0, x[None, :]*m1 + b1)
     
 class ExponentialFunction:
     def __init__(self, params):
         self.params = params 
     def __call__(self, x):
-        a, b = self.params
-        return np.array([a * np.exp(b * xi) + 1 - a for xi in x])
\ No newline at end of file
+        return self.evaluate(np.asarray(self.params)[None, :], np.asarray(x, dtype=float))[0]
+    @staticmethod
+    def evaluate(params, x):
+        ''' params [M, 2], time points [K] -> [M, K] '''
+        a, b = [p[:, None] for p in params.T]
+        return a * np.exp(b * x[None, :]) + 1 - a
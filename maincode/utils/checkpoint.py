@@ -2,49 +2,268 @@ import torch
 import numpy as np
 import random
 import os
+import json
+import atexit
+import threading
 
-def save_checkpoint(epoch, model, optimizer, loss, lossfunction, setup, path):
+# ================================================================================================================================================
+# ===========================================================  Asynchronous Writer  ==============================================================
+# ================================================================================================================================================
+# checkpoints are written by a background thread, a file is first written to a temporary file and then renamed,
+# such that an interrupted write never leaves a broken checkpoint behind
+# if a file is saved again before the previous state was written, only the latest state is written
+
+class CheckpointWriter():
+    def __init__(self):
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.writing = None
+        self.thread = None
+        self.error = None
+
+    def Save(self, obj, filename):
+        with self.condition:
+            self.pending[filename] = obj
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.Run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def Run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                filename, obj = self.pending.popitem()
+                self.writing = filename
+            try:
+                torch.save(obj, f'{filename}.tmp')
+                os.replace(f'{filename}.tmp', filename)
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.writing = None
+                self.condition.notify_all()
+
+    def Flush(self, filename=None):
+        # waits until the file (or all files) are written
+        with self.condition:
+            while (filename in self.pending or self.writing == filename) if filename else (self.pending or self.writing):
+                self.condition.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+WRITER = CheckpointWriter()
+atexit.register(WRITER.Flush)
+
+# ================================================================================================================================================
+# ============================================================  Training State  ==================================================================
+# ================================================================================================================================================
+# only the state changed by training is saved: trainable parameters, pruning masks, optimizer state,
+# lagrangian multipliers and random states, the surrogate models are reconstructed by the network
+
+def GetModelState(model):
+    state = {'parameters': {name: p.detach().clone() for name, p in model.named_parameters() if p.requires_grad}, 'layers': {}}
+    for name, m in model.named_modules():
+        if hasattr(m, 'theta_mask'):
+            state['layers'][name] = {'theta_mask': m.theta_mask.clone(), 'act_mask': m.act_mask.clone(),
+                                     'inv_mask': m.inv_mask.clone(), 'pruned': m.pruned}
+    return state
+
+def SetModelState(model, state):
+    parameters = dict(model.named_parameters())
+    with torch.no_grad():
+        for name, value in state['parameters'].items():
+            parameters[name].copy_(value)
+    for name, m in model.named_modules():
+        if name in state['layers']:
+            m.theta_mask = state['layers'][name]['theta_mask'].clone()
+            m.act_mask = state['layers'][name]['act_mask'].clone()
+            m.inv_mask = state['layers'][name]['inv_mask'].clone()
+            m.pruned = state['layers'][name]['pruned']
+        if hasattr(m, 'ClearCache'):
+            m.ClearCache()
+    return model
+
+def GetOptimizerState(optimizer, model):
+    # the parameters of each group are identified by their names, as the groups are reassigned during training
+    names = {id(p): name for name, p in model.named_parameters()}
+    state = optimizer.state_dict()
+    state['state'] = {k: {n: v.clone() if torch.is_tensor(v) else v for n, v in s.items()} for k, s in state['state'].items()}
+    state['names'] = [[names[id(p)] for p in g['params']] for g in optimizer.param_groups]
+    return state
+
+def SetOptimizerState(optimizer, model, state):
+    parameters = dict(model.named_parameters())
+    for g, names in zip(optimizer.param_groups, state['names']):
+        g['params'] = [parameters[name] for name in names]
+    # the optimizer updates its state in place, the stored state must stay unchanged
+    states = {k: {n: v.clone() if torch.is_tensor(v) else v for n, v in s.items()} for k, s in state['state'].items()}
+    optimizer.load_state_dict({'state': states, 'param_groups': state['param_groups']})
+    return optimizer
+
+def GetRandomState():
+    return {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.random.get_rng_state()}
+
+def SetRandomState(random_state):
+    random.setstate(random_state['random'])
+    np.random.set_state(random_state['numpy'])
+    torch.random.set_rng_state(random_state['torch'])
+
+# ================================================================================================================================================
+# ==============================================================  Checkpoints  ===================================================================
+# ================================================================================================================================================
+
+def GetTrainingState(epoch, model, optimizer, loss, lossfunction, generator=None):
+    # generator: own random generator of the training (e.g. of a seed in lockstep training), saved with the global random states
+    state = {'epoch': epoch, 'model': GetModelState(model), 'optimizer': GetOptimizerState(optimizer, model), 'loss': loss,
+             'multipliers': {'lambda_': lossfunction.args.lambda_, 'mu': lossfunction.args.mu}, 'random_state': GetRandomState()}
+    if generator is not None:
+        state['random_state']['generator'] = generator.get_state()
+    return state
+
+def SetTrainingState(state, model, optimizer=None, lossfunction=None, generator=None):
+    SetRandomState(state['random_state'])
+    if generator is not None and 'generator' in state['random_state']:
+        generator.set_state(state['random_state']['generator'])
+    SetModelState(model, state['model'])
+    if optimizer is not None:
+        SetOptimizerState(optimizer, model, state['optimizer'])
+    if lossfunction is not None:
+        lossfunction.args.lambda_ = state['multipliers']['lambda_']
+        lossfunction.args.mu = state['multipliers']['mu']
+    return state['epoch'], model, optimizer, state['loss'], lossfunction
+
+# the latest checkpoint of every setup is kept in memory, reloading it (e.g. the best network at the end of a training phase)
+# does not touch the disk, the checkpoint is written to disk for crash recovery only if persist is set or persist_checkpoint is called
+CHECKPOINTS = {}
+
+def save_checkpoint(epoch, model, optimizer, loss, lossfunction, setup, path, persist=True, generator=None):
     filename = f'{path}/{setup}.ckp'
-    if not os.path.exists(path):
-        os.makedirs(path)
+    CHECKPOINTS[filename] = {'state': GetTrainingState(epoch, model, optimizer, loss, lossfunction, generator), 'persisted': False}
+    if persist:
+        persist_checkpoint(setup, path)
+    return None
 
-    random_state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.random.get_rng_state()}
-    checkpoint = {'epoch': epoch, 'model': model, 'optimizer': optimizer, 'loss': loss, 'lossfunction':lossfunction, 'random_state': random_state}
-    torch.save(checkpoint, filename)
+def persist_checkpoint(setup, path):
+    filename = f'{path}/{setup}.ckp'
+    if filename in CHECKPOINTS and not CHECKPOINTS[filename]['persisted']:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        WRITER.Save(CHECKPOINTS[filename]['state'], filename)
+        CHECKPOINTS[filename]['persisted'] = True
     return None
 
-def load_checkpoint(setup, path):
-    if os.path.isfile(f'{path}/{setup}.ckp'):
-        checkpoint = torch.load(f'{path}/{setup}.ckp')
-        random.setstate(checkpoint['random_state']['random'])
-        np.random.set_state(checkpoint['random_state']['numpy'])
-        torch.random.set_rng_state(checkpoint['random_state']['torch'])
-        epoch = checkpoint['epoch']
-        model = checkpoint['model']
-        optimizer = checkpoint['optimizer']
-        loss = checkpoint['loss']
-        lossfunction = checkpoint['lossfunction']
-        return epoch+1, model, optimizer, loss, lossfunction
+def load_checkpoint(setup, path, model, optimizer=None, lossfunction=None, generator=None):
+    # loads the checkpoint into the given network, optimizer and lossfunction
+    filename = f'{path}/{setup}.ckp'
+    if filename in CHECKPOINTS:
+        checkpoint = CHECKPOINTS[filename]['state']
+    elif os.path.isfile(filename):
+        checkpoint = torch.load(filename)
+        if isinstance(checkpoint['model'], torch.nn.Module):
+            # checkpoint with pickled objects
+            checkpoint['optimizer'] = GetOptimizerState(checkpoint['optimizer'], checkpoint['model'])
+            checkpoint['model'] = GetModelState(checkpoint['model'])
+            checkpoint['multipliers'] = {'lambda_': checkpoint['lossfunction'].args.lambda_, 'mu': checkpoint['lossfunction'].args.mu}
+        CHECKPOINTS[filename] = {'state': checkpoint, 'persisted': True}
     else:
         return None
-    
+    epoch, model, optimizer, loss, lossfunction = SetTrainingState(checkpoint, model, optimizer, lossfunction, generator)
+    return epoch+1, model, optimizer, loss, lossfunction
+
+def remove_checkpoint(setup, path):
+    filename = f'{path}/{setup}.ckp'
+    CHECKPOINTS.pop(filename, None)
+    WRITER.Flush(filename)
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+# ================================================================================================================================================
+# ===============================================================  Recording  ====================================================================
+# ================================================================================================================================================
+# the trajectory of a training is appended to one file {setup}.record with a fixed-size row per recorded epoch,
+# the layout of the rows is kept in {setup}.record.json, such that the file can be memory mapped and any epoch read directly,
+# a row holds the trainable parameters and the pruning masks of each layer ({layer}.theta_mask, ... as uint8)
+# the size is only reduced by recording every record_freq epochs: deltas to the previous row would have the same fixed size
+# and an epoch could no longer be read without summing up all rows before it
+
+RECORDS = {}
+MASKS = ['theta_mask', 'act_mask', 'inv_mask', 'pruned']
+
+def RecordDtype(model):
+    fields = [('epoch', '<i8'), ('train_loss', '<f4'), ('valid_loss', '<f4')]
+    fields += [(name, '<f4', tuple(p.shape)) for name, p in model.named_parameters() if p.requires_grad]
+    for name, m in model.named_modules():
+        if hasattr(m, 'theta_mask'):
+            fields += [(f'{name}.{mask}', '|u1', tuple(getattr(m, mask).shape)) for mask in MASKS[:3]] + [(f'{name}.pruned', '|u1')]
+    return np.dtype(fields)
+
+def ReadRecordDtype(filename):
+    with open(f'{filename}.json', 'r') as f:
+        return np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in json.load(f)])
+
 def record_checkpoint(epoch, model, train_loss, valid_loss, setup, path):
-    filename = f'{path}/{setup}_epoch_{epoch}.ckp'
-    if not os.path.exists(path):
-        os.makedirs(path)
+    filename = f'{path}/{setup}.record'
+    if filename not in RECORDS:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.isfile(f'{filename}.json'):
+            dtype = ReadRecordDtype(filename)
+            # drop a row that was not completely written before an interruption
+            if os.path.isfile(filename):
+                with open(filename, 'r+b') as f:
+                    f.truncate(os.path.getsize(filename) // dtype.itemsize * dtype.itemsize)
+        else:
+            dtype = RecordDtype(model)
+            with open(f'{filename}.json', 'w') as f:
+                json.dump(dtype.descr, f)
+        RECORDS[filename] = dtype
+    dtype = RECORDS[filename]
 
-    checkpoint = {'epoch': epoch, 'model': model, 'train_loss': train_loss, 'valid_loss': valid_loss}
-    torch.save(checkpoint, filename)
+    row = np.zeros(1, dtype=dtype)
+    row['epoch'] = epoch
+    row['train_loss'] = float(train_loss)
+    row['valid_loss'] = float(valid_loss)
+    for name, p in model.named_parameters():
+        if p.requires_grad:
+            row[name] = p.detach().cpu().numpy()
+    for name, m in model.named_modules():
+        if f'{name}.pruned' in dtype.names:
+            for mask in MASKS[:3]:
+                row[f'{name}.{mask}'] = getattr(m, mask).detach().cpu().numpy()
+            row[f'{name}.pruned'] = m.pruned
+    with open(filename, 'ab') as f:
+        f.write(row.tobytes())
     return None
 
+def load_record(setup, path):
+    # memory-mapped trajectory, e.g. record['valid_loss'] or record['model.0-th pLayer.theta_'][i]
+    filename = f'{path}/{setup}.record'
+    if not os.path.isfile(filename):
+        return None
+    dtype = ReadRecordDtype(filename)
+    N = os.path.getsize(filename) // dtype.itemsize
+    if N == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(N,))
+
 def load_recorded_checkpoint(epoch, setup, path):
-    if os.path.isfile(f'{path}/{setup}_epoch_{epoch}.ckp'):
-        checkpoint = torch.load(f'{path}/{setup}_epoch_{epoch}.ckp')
-        epoch = checkpoint['epoch']
-        model = checkpoint['model']
-        train_loss = checkpoint['train_loss']
-        valid_loss = checkpoint['valid_loss']
-        lossfunction = checkpoint['lossfunction']
-        return epoch, model, train_loss, valid_loss
-    else:
-        return None
\ No newline at end of file
+    # the model state can be loaded into a network by SetModelState(model, state), including the masks of a fine tuning
+    record = load_record(setup, path)
+    if record is None:
+        return None
+    index = np.nonzero(record['epoch'] == epoch)[0]
+    if not len(index):
+        return None
+    # if an epoch was recorded several times (restart from a checkpoint), the last recording is used
+    row = record[index[-1]]
+    state = {'parameters': {}, 'layers': {}}
+    layers = [name[:-len('.pruned')] for name in record.dtype.names if name.endswith('.pruned')]
+    for layer in layers:
+        state['layers'][layer] = {mask: torch.tensor(np.array(row[f'{layer}.{mask}']), dtype=torch.float32) for mask in MASKS[:3]}
+        state['layers'][layer]['pruned'] = bool(row[f'{layer}.pruned'])
+    masks = set([f'{layer}.{mask}' for layer in layers for mask in MASKS])
+    state['parameters'] = {name: torch.tensor(np.array(row[name])) for name in record.dtype.names[3:] if name not in masks}
+    return epoch, state, row['train_loss'].item(), row['valid_loss'].item()
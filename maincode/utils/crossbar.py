@@ -0,0 +1,99 @@
+import torch
+
+# ================================================================================================================================================
+# =============================================================  Crossbar Functions  =============================================================
+# ================================================================================================================================================
+# the functions work on a single layer (a: [E, M], theta: [M, N]) as well as on a stack of S layers (a: [S, E, M], theta: [S, M, N])
+
+def ExtendInput(a):
+    # append the constant inputs for the bias (1) and the zero (0) row of the crossbar
+    shape = list(a.shape[:-1]) + [1]
+    return torch.cat([a, torch.ones(shape).to(a.device), torch.zeros(shape).to(a.device)], dim=-1)
+
+def SignMask(theta):
+    # positive and negative crossbar cells, not differentiable
+    positive = (theta >= 0).to(theta.dtype)
+    return positive, 1. - positive
+
+def CrossbarMAC(a_extend, a_neg, W, positive, negative):
+    return torch.matmul(a_extend, W * positive) + torch.matmul(a_neg, W * negative)
+
+class CrossbarPowerFunction(torch.autograd.Function):
+    # power of the crossbar cells from the moments of the voltages: sum_e (x - y)^2 = sum_e x^2 - 2 sum_e x*y + sum_e y^2,
+    # neither forward nor backward build the voltages of all cells and samples ([(S,) E, M, N]), the masks are not differentiable
+    @staticmethod
+    def forward(ctx, x_extend, x_neg, y, g_tilde, positive, negative):
+        X2 = x_extend.pow(2.).sum(dim=-2).unsqueeze(-1)
+        N2 = x_neg.pow(2.).sum(dim=-2).unsqueeze(-1)
+        Y2 = y.pow(2.).sum(dim=-2).unsqueeze(-2)
+        XY = torch.matmul(x_extend.transpose(-1, -2), y)
+        NY = torch.matmul(x_neg.transpose(-1, -2), y)
+        # squared voltage drop summed over samples: [(S,) M, N]
+        V2 = positive * (X2 - 2. * XY) + negative * (N2 - 2. * NY) + Y2
+        g_pos, g_neg = g_tilde * positive, g_tilde * negative
+        ctx.save_for_backward(x_extend, x_neg, y, g_pos, g_neg, V2)
+        return torch.sum(g_tilde * V2, dim=(-2, -1)) / x_extend.shape[-2]
+
+    @staticmethod
+    def backward(ctx, grad):
+        x_extend, x_neg, y, g_pos, g_neg, V2 = ctx.saved_tensors
+        # d/dx of sum_e (x - y)^2 / E is 2 (x - y) / E
+        scale = (2. * grad / x_extend.shape[-2]).view(*grad.shape, 1, 1)
+        grad_x = grad_n = grad_y = grad_g = None
+        if ctx.needs_input_grad[0]:
+            grad_x = scale * (x_extend * g_pos.sum(dim=-1).unsqueeze(-2) - torch.matmul(y, g_pos.transpose(-1, -2)))
+        if ctx.needs_input_grad[1]:
+            grad_n = scale * (x_neg * g_neg.sum(dim=-1).unsqueeze(-2) - torch.matmul(y, g_neg.transpose(-1, -2)))
+        if ctx.needs_input_grad[2]:
+            grad_y = scale * (y * (g_pos + g_neg).sum(dim=-2).unsqueeze(-2) - torch.matmul(x_extend, g_pos) - torch.matmul(x_neg, g_neg))
+        if ctx.needs_input_grad[3]:
+            grad_g = scale / 2. * V2
+        return grad_x, grad_n, grad_y, grad_g, None, None
+
+def CrossbarPower(x_extend, x_neg, y, g_tilde, positive, negative):
+    return CrossbarPowerFunction.apply(x_extend, x_neg, y, g_tilde, positive, negative)
+
+# ================================================================================================================================================
+# ===========================================================  Stack of Printed Circuits  ========================================================
+# ================================================================================================================================================
+
+class pNNStack(torch.nn.Module):
+    # S pNNs with the same topology (e.g. different seeds) evaluated in one batched forward pass
+    # parameters, circuits, masks and optimizers stay with the individual pNNs, the stack only batches the computation
+    def __init__(self, pnns):
+        super().__init__()
+        self.pnns = torch.nn.ModuleList(pnns)
+
+    def StackEta(self, circuits):
+        # [S, 4] -> [4, S, 1, 1], broadcasting over samples and neurons of each pNN
+        eta = torch.stack([c.eta for c in circuits])
+        return eta.t().reshape(eta.shape[1], eta.shape[0], 1, 1)
+
+    def forward(self, X):
+        # X: [S, E, N_feature], or [E, N_feature] shared by all pNNs -> [S, E, N_class]
+        S = len(self.pnns)
+        a = X if X.dim() == 3 else X.expand(S, *X.shape)
+
+        act, inv = self.pnns[0].act, self.pnns[0].inv
+        eta_act = self.StackEta([pnn.act for pnn in self.pnns])
+        eta_inv = self.StackEta([pnn.inv for pnn in self.pnns])
+
+        for layers in zip(*[pnn.model for pnn in self.pnns]):
+            theta = torch.stack([layer.theta for layer in layers])
+            W = torch.stack([layer.W for layer in layers])
+            g_tilde = torch.stack([layer.g_tilde for layer in layers])
+            act_mask = torch.stack([layer.act_mask for layer in layers])
+
+            a_extend = ExtendInput(a)
+            a_neg = inv(a_extend, eta_inv)
+            a_neg[:, :, -1] = 0.
+            positive, negative = SignMask(theta)
+            z = CrossbarMAC(a_extend, a_neg, W, positive, negative)
+            mac_power = CrossbarPower(a_extend, a_neg, z, g_tilde, positive.detach(), negative.detach())
+            a = act(z, eta_act) * act_mask
+
+            # keep the per-pNN power terms, such that pNN.Power works as after its own forward pass
+            for s, layer in enumerate(layers):
+                layer.mac_power = mac_power[s]
+                layer.act_power = layer.ACT.power * torch.sum(layer.act_mask)
+        return a
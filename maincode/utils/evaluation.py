@@ -18,11 +18,46 @@ class Evaluator(torch.nn.Module):
         corrects = (act[:,0] >= self.sensing_margin) & (act[:,1]<=0) & (label.view(-1)==idx[:,0])
         return corrects.float().sum().item() / label.numel()
         
-    def forward(self, nn, x, label):
+    def SelectMetric(self):
         if self.args.metric == 'acc':
             self.performance = self.nominal
         elif self.args.metric == 'maa':
             self.performance = self.maa
+
+    def forward(self, nn, x, label):
+        self.SelectMetric()
         return self.performance(nn(x), label), nn.Power
-    
-  
\ No newline at end of file
+
+    def step(self, nn, lossfunction, x, label):
+        # loss, performance and power breakdown from one forward pass
+        self.SelectMetric()
+        prediction = nn(x)
+        power = nn.PowerBreakdown
+        loss = lossfunction.objective(prediction, label, power['total'])
+        return loss, self.performance(prediction, label), power
+
+    def epoch(self, nn, lossfunction, loader, backward=False):
+        # loss, performance and power breakdown of a whole split, reduced over its batches (weighted by their size),
+        # with backward the gradients of the batches are accumulated with the same weights, such that a split cut into
+        # batches by MAX_BATCH still yields one optimizer step per epoch, a single full batch is unchanged
+        N = len(loader.dataset)
+        loss, performance, power = 0., 0., {}
+        for x, label in loader:
+            weight = x.shape[0] / N
+            L, p, P = self.step(nn, lossfunction, x, label)
+            if backward:
+                (L * weight).backward()
+            loss = loss + L.detach() * weight
+            performance += p * weight
+            for k, v in P.items():
+                power[k] = power.get(k, 0.) + v.detach() * weight
+        return loss, performance, power
+
+    def MeanPower(self, nn, loader):
+        # power of the whole split, averaged over its batches
+        N = len(loader.dataset)
+        power = 0.
+        for x, _ in loader:
+            nn(x)
+            power = power + nn.Power * x.shape[0] / N
+        return power
@@ -0,0 +1,40 @@
+import math
+
+# ================================================================================================================================================
+# ========================================================  Lagrangian Multiplier Update  =========================================================
+# ================================================================================================================================================
+# update of the lagrangian multiplier lambda and the penalty factor mu after an (inexact) inner solve with constraint violation C,
+# the growth of mu is selected by args.AL_MU_UPDATE:
+#   add:      mu + AL_MU_STEP
+#   mul:      mu * AL_MU_FACTOR, AL_MU_STEP if mu = 0 (the schedule mu *= 1.5 of the original training, which stays at mu = 0)
+#   adaptive: mu * AL_MU_FACTOR (at least AL_MU_STEP) only if the violation did not decrease below AL_DECREASE * previous violation
+
+class MultiplierUpdate():
+    def __init__(self, args):
+        self.args = args
+        self.update = args.AL_MU_UPDATE
+        self.C_previous = math.inf
+        self.N_update = 0
+
+    def GrowPenalty(self, mu, C):
+        if self.update == 'add':
+            return mu + self.args.AL_MU_STEP
+        elif self.update == 'mul':
+            return mu * self.args.AL_MU_FACTOR if mu > 0 else self.args.AL_MU_STEP
+        elif self.update == 'adaptive':
+            if C > self.args.AL_DECREASE * self.C_previous:
+                return max(mu * self.args.AL_MU_FACTOR, self.args.AL_MU_STEP)
+            else:
+                return mu
+        else:
+            raise ValueError(f'unknown update of penalty factor: {self.update}')
+
+    def Feasible(self, C):
+        return float(C) <= self.args.AL_TOL
+
+    def __call__(self, lossfunction, C):
+        self.N_update += 1
+        lossfunction.args.lambda_ = max(0., float(lossfunction.args.lambda_ + lossfunction.args.mu * C))
+        lossfunction.args.mu = self.GrowPenalty(lossfunction.args.mu, float(C))
+        self.C_previous = float(C)
+        return lossfunction
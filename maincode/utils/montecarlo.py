@@ -0,0 +1,98 @@
+import torch
+import numpy as np
+from .evaluation import *
+from .crossbar import ExtendInput, SignMask, CrossbarMAC, CrossbarPower
+
+# ================================================================================================================================================
+# ===========================================================  Monte Carlo Evaluation  ===========================================================
+# ================================================================================================================================================
+# robustness of a trained pNN against
+#   - printing variation: each conductance is scaled by a uniform factor in [1-e_test, 1+e_test], N_test draws
+#   - aging: each conductance follows its own aging model, M_test draws of models, evaluated at K_test time points in [0, t_test_max]
+#   - input noise: R_test noisy copies of the inputs with relative gaussian noise IN_test, as in the test loader
+# the N_test x M_test x K_test perturbed circuits (instances) get a leading dimension and are evaluated in chunks of MC_CHUNK instances
+# the perturbations are drawn chunk by chunk, such that the memory scales with MC_CHUNK and not with N_test x M_test x K_test
+
+class MonteCarloEvaluator():
+    def __init__(self, args, sampler=None):
+        self.args = args
+        # aging models are only needed if the circuits age
+        if sampler is None and args.t_test_max > 0 and args.K_test > 1:
+            sampler = torch.load('./utils/aging_model_exp')
+        self.sampler = sampler
+        self.evaluator = Evaluator(args)
+        self.evaluator.SelectMetric()
+
+    def Variation(self, shapes, seed, n):
+        # printing variation of draw n: [M+2, N] per layer, from its own random stream, such that every chunk sees the same draw
+        rng = np.random.default_rng([seed, 0, n])
+        return [torch.from_numpy(1. + self.args.e_test * (2. * rng.random(s) - 1.)).to(torch.get_default_dtype()) for s in shapes]
+
+    def Aging(self, shapes, seed, m):
+        # aging models of draw m evaluated at the K_test time points: [K_test, M+2, N] per layer
+        t = np.linspace(0., self.args.t_test_max, self.args.K_test)
+        sizes = [int(np.prod(s)) for s in shapes]
+        aging = self.sampler.get_aging_factors(sum(sizes), t, random_state=np.random.default_rng([seed, 1, m])).transpose(0, 1)
+        return [a.reshape(self.args.K_test, *s) for a, s in zip(torch.split(aging, sizes, dim=-1), shapes)]
+
+    def Factors(self, layers, seed, start, stop):
+        # multiplicative perturbation of each conductance of the instances start, ..., stop-1 (in the order N_test x M_test x K_test):
+        # [stop-start, M+2, N] per layer, only the variation and aging draws used by these instances are made
+        M, K = self.args.M_test, self.args.K_test
+        shapes = [tuple(l.theta.shape) for l in layers]
+        index = torch.arange(start, stop)
+        n, m, k = (index // (M * K)).tolist(), (index // K % M).tolist(), (index % K).tolist()
+        variation = {i: self.Variation(shapes, seed, i) for i in set(n)}
+        factors = [torch.stack([variation[i][l] for i in n]) for l in range(len(shapes))]
+        if self.sampler is None:
+            return factors
+        aging = {i: self.Aging(shapes, seed, i) for i in set(m)}
+        return [f * torch.stack([aging[i][l][j] for i, j in zip(m, k)]) for l, f in enumerate(factors)]
+
+    def Instances(self, pnn, X, factors):
+        # outputs [S, E*R, N_class] and power [S] of S perturbed circuits
+        S = factors[0].shape[0]
+        X = X.repeat(self.args.R_test, 1)
+        a = X * (torch.randn([S, *X.shape]) * self.args.IN_test + 1.)
+        power = (pnn.inv.power * pnn.soft_count_neg + pnn.act.power * pnn.soft_count_act).expand(S).clone()
+        for layer, factor in zip(pnn.model, factors):
+            theta = layer.theta * factor
+            theta_abs = theta.abs()
+            W = theta_abs / (torch.sum(theta_abs, dim=-2, keepdim=True) + 1e-10)
+            # factors are positive, the signs of the cells do not change
+            positive, negative = SignMask(layer.theta)
+            g = layer.g_tilde * factor
+
+            a_extend = ExtendInput(a)
+            a_neg = pnn.inv(a_extend)
+            a_neg[..., -1] = 0.
+            z = CrossbarMAC(a_extend, a_neg, W, positive, negative)
+            power = power + CrossbarPower(a_extend, a_neg, z, g, positive, negative)
+            a = pnn.act(z) * layer.act_mask
+        return a, power
+
+    def forward(self, pnn, X, y):
+        # performance and power of all N_test x M_test x K_test instances, each of shape [N_test, M_test, K_test]
+        pnn = pnn.Expand()
+        N, M, K = self.args.N_test, self.args.M_test, self.args.K_test
+        chunk = self.args.MC_CHUNK if self.args.MC_CHUNK > 0 else N * M * K
+        performance, power = [], []
+        # the draws of the chunks are derived from one seed of the global random state
+        seed = np.random.randint(2**31)
+        with torch.no_grad():
+            for start in range(0, N * M * K, chunk):
+                factors = self.Factors(list(pnn.model), seed, start, min(start + chunk, N * M * K))
+                prediction, P = self.Instances(pnn, X, factors)
+                label = y.repeat(self.args.R_test)
+                performance += [self.evaluator.performance(p, label) for p in prediction]
+                power.append(P)
+        return np.array(performance).reshape(N, M, K), torch.cat(power).cpu().numpy().reshape(N, M, K)
+
+    def __call__(self, pnn, X, y):
+        return self.forward(pnn, X, y)
+
+
+def MonteCarloSummary(values, scale=1.):
+    values = np.asarray(values).ravel() * scale
+    q = np.quantile(values, [0.05, 0.5, 0.95])
+    return f'mean {values.mean():.4f} | std {values.std():.4f} | min {values.min():.4f} | 5% {q[0]:.4f} | median {q[1]:.4f} | 95% {q[2]:.4f}'
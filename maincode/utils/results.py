@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import math
+import torch
+import numpy as np
+from .evaluation import *
+
+# ================================================================================================================================================
+# ==============================================================  Results Index  =================================================================
+# ================================================================================================================================================
+# append-only index of the trained pNNs, one json line per record, written at the end of pretraining (PT) and fine tuning (FT),
+# a record is keyed by dataset, seed, power estimator, power balance / target and stage, a later record of the same key replaces earlier ones,
+# aggregation and pareto extraction only read the index and never load models
+
+KEY = ('dataset', 'seed', 'powerestimator', 'powerbalance', 'POWER', 'stage')
+
+def EvaluateRecord(pnn, loader, evaluator):
+    # performance and power breakdown (uW) of one split, reduced over its batches
+    N = len(loader.dataset)
+    performance, power = 0., {}
+    with torch.no_grad():
+        for x, y in loader:
+            weight = x.shape[0] / N
+            performance += evaluator.performance(pnn(x), y) * weight
+            for k, v in pnn.PowerBreakdown.items():
+                power[k] = power.get(k, 0.) + v.item() * 1e6 * weight
+    return performance, power
+
+def WriteResult(args, pnn, stage, setup, datainfo, valid_loader, test_loader, finished=True, pruned=None):
+    evaluator = Evaluator(args)
+    evaluator.SelectMetric()
+    record = {'dataset': datainfo['dataname'], 'seed': args.SEED, 'powerestimator': args.powerestimator,
+              'powerbalance': float(args.powerbalance), 'POWER': round(args.POWER * 1e6, 6), 'stage': stage,
+              'setup': setup, 'metric': args.metric, 'finished': bool(finished), 'time': time.time()}
+    for split, loader in [('valid', valid_loader), ('test', test_loader)]:
+        performance, power = EvaluateRecord(pnn, loader, evaluator)
+        record[f'{split}_performance'] = performance
+        record.update({f'{split}_power_{k}': v for k, v in power.items()})
+    # printed components, and the components removed by pruning before fine tuning
+    with torch.no_grad():
+        record['N_theta'] = float(pnn.soft_count_theta)
+        record['N_act'] = float(pnn.soft_count_act)
+        record['N_neg'] = float(pnn.soft_count_neg)
+    if pruned is not None:
+        record.update({k: float(v) for k, v in zip(['pruned_theta', 'pruned_act', 'pruned_neg', 'ratio_theta', 'ratio_act', 'ratio_neg'], pruned)})
+
+    # one line per write, appended such that several experiments can share one index
+    with open(args.resultfile, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+def ReadResults(filename, **conditions):
+    # latest record of each key, optionally filtered, e.g. ReadResults(file, stage='FT', powerestimator='AL')
+    records = {}
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[tuple(record[k] for k in KEY)] = record
+    return [r for r in records.values() if all(r[k] == v for k, v in conditions.items())]
+
+def AggregateResults(records, by=('dataset', 'powerestimator', 'POWER', 'stage'), fields=('test_performance', 'test_power_total')):
+    # mean, std and number of records (e.g. seeds) of each field for each group
+    groups = {}
+    for r in records:
+        groups.setdefault(tuple(r[k] for k in by), []).append(r)
+    table = {}
+    for group, rs in sorted(groups.items(), key=lambda item: str(item[0])):
+        values = {f: np.array([r[f] for r in rs], dtype=float) for f in fields}
+        table[group] = {'N': len(rs), **{f'{f}_mean': float(v.mean()) for f, v in values.items()}, **{f'{f}_std': float(v.std()) for f, v in values.items()}}
+    return table
+
+def ParetoFront(records, performance='valid_performance', power='valid_power_total', by=('dataset',)):
+    # records that are not dominated (higher performance at lower or equal power) within each group, sorted by power
+    groups = {}
+    for r in records:
+        groups.setdefault(tuple(r[k] for k in by), []).append(r)
+    fronts = {}
+    for group, rs in groups.items():
+        front, best = [], -math.inf
+        for r in sorted(rs, key=lambda r: (r[power], -r[performance])):
+            if r[performance] > best:
+                front.append(r)
+                best = r[performance]
+        fronts[group] = front
+    return fronts
@@ -2,9 +2,12 @@ import time
 import math
 from .checkpoint import *
 from .evaluation import *
+from .lagrangian import *
 import os
 
 def train_pnn(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID='default'):
+    # a fallback of the compiled forward pass is reported to the message logger
+    nn.msglogger = logger
     tmpdir = os.getenv('TMPDIR', default='.')
     args.temppath = tmpdir
     
@@ -17,8 +20,9 @@ def train_pnn(nn, train_loader, valid_loader, lossfunction, optimizer, args, log
     
     early_stop = False
     
-    if load_checkpoint(UUID, args.temppath):
-        current_epoch, nn, optimizer, best_valid_loss, lossfunction = load_checkpoint(UUID, args.temppath)
+    checkpoint = load_checkpoint(UUID, args.temppath, nn, optimizer, lossfunction)
+    if checkpoint:
+        current_epoch, nn, optimizer, best_valid_loss, lossfunction = checkpoint
         logger.info(f'Restart previous training from {current_epoch} epoch')
         print(f'Restart previous training from {current_epoch} epoch')
         
@@ -27,34 +31,31 @@ def train_pnn(nn, train_loader, valid_loader, lossfunction, optimizer, args, log
         
         msg = ''
         
-        for x_train, y_train in train_loader:
-            msg += f'hyperparameters in printed neural network for training :\nepoch : {epoch:-6d} |\n'
-            
-            L_train = lossfunction(nn, x_train, y_train)
-            train_acc, train_power = evaluator(nn, x_train, y_train)
-            optimizer.zero_grad()
-            L_train.backward()
-            optimizer.step()
+        msg += f'hyperparameters in printed neural network for training :\nepoch : {epoch:-6d} |\n'
+        # gradients are accumulated over the batches of the training set, one step per epoch
+        optimizer.zero_grad()
+        L_train, train_acc, train_power = evaluator.epoch(nn, lossfunction, train_loader, backward=True)
+        optimizer.step()
 
         with torch.no_grad():
-            for x_valid, y_valid in valid_loader:
-                msg += f'hyperparameters in printed neural network for validation :\nepoch : {epoch:-6d} |\n'
-                
-                L_valid = lossfunction(nn, x_valid, y_valid)
-                valid_acc, valid_power = evaluator(nn, x_valid, y_valid)
+            msg += f'hyperparameters in printed neural network for validation :\nepoch : {epoch:-6d} |\n'
+            L_valid, valid_acc, valid_power = evaluator.epoch(nn, lossfunction, valid_loader)
         
         logger.debug(msg)
         
-        if args.recording:
+        if args.recording and args.record_freq and not epoch % args.record_freq:
             record_checkpoint(epoch, nn, L_train, L_valid, UUID, args.recordpath)
             
         if L_valid.item() < best_valid_loss:
             best_valid_loss = L_valid.item()
-            save_checkpoint(epoch, nn, optimizer, best_valid_loss, lossfunction, UUID, args.temppath)
+            save_checkpoint(epoch, nn, optimizer, best_valid_loss, lossfunction, UUID, args.temppath, persist=False)
             patience = 0
         else:
             patience += 1
 
+        if args.ckp_freq and not epoch % args.ckp_freq:
+            persist_checkpoint(UUID, args.temppath)
+
         if patience > args.PATIENCE:
             print('Early stop.')
             logger.info('Early stop.')
@@ -74,20 +75,24 @@ def train_pnn(nn, train_loader, valid_loader, lossfunction, optimizer, args, log
         if not epoch % args.report_freq:
             print(f'| Epoch: {epoch:-6d} | Train loss: {L_train.item():.4f} | Valid loss: {L_valid.item():.4f} | Train acc: {train_acc:.4f} | Valid acc: {valid_acc:.4f} |'\
                   f' patience: {patience:-3d} | lr: {current_lr:.3e} | Epoch time: {end_epoch_time-start_epoch_time:.1f} |'\
-                  f' Power: {train_power.item():.2e} | lambda: {lossfunction.args.lambda_:.3e} | mu: {lossfunction.args.mu:.3e} |')
+                  f' Power: {train_power["total"].item():.2e} | lambda: {lossfunction.args.lambda_:.3e} | mu: {lossfunction.args.mu:.3e} |')
             logger.info(f'| Epoch: {epoch:-6d} | Train loss: {L_train.item():.4f} | Valid loss: {L_valid.item():.4f} | Train acc: {train_acc:.4f} | Valid acc: {valid_acc:.4f} |'\
                         f' patience: {patience:-3d} | lr: {current_lr:.3e} | Epoch time: {end_epoch_time-start_epoch_time:.1f} |'\
-                        f' Power: {train_power.item():.2e} | lambda: {lossfunction.args.lambda_:.3e} | mu: {lossfunction.args.mu:.3e} |')
+                        f' Power: {train_power["total"].item():.2e} | lambda: {lossfunction.args.lambda_:.3e} | mu: {lossfunction.args.mu:.3e} |')
         
-    _, resulted_nn, _,_,_ = load_checkpoint(UUID, args.temppath)
+    # load the best network from memory, the optimizer continues without state as for a newly constructed network
+    load_checkpoint(UUID, args.temppath, nn)
+    optimizer.state.clear()
     
     if early_stop:
-        os.remove(f'{args.temppath}/{UUID}.ckp')
+        remove_checkpoint(UUID, args.temppath)
+    else:
+        persist_checkpoint(UUID, args.temppath)
 
-    return resulted_nn, early_stop, optimizer, epoch
+    return nn, early_stop, optimizer, epoch
 
 
-def train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch=0, UUID='default'):
+def train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch=0, UUID='default', lr_min=None):
     tmpdir = os.getenv('TMPDIR', default='.')
     args.temppath = tmpdir
     
@@ -95,8 +100,10 @@ def train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimize
     UUID += '_progressive'
 
     current_lr = math.inf
+    if lr_min is None:
+        lr_min = args.LR_MIN
     
-    while current_lr > args.LR_MIN:
+    while current_lr > lr_min:
         early_stop = False
         
         nn, early_stop, optimizer, current_epoch = train_pnn(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID)
@@ -120,7 +127,7 @@ def train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimize
             logger.warning('Time limination reached.')
             return nn, early_stop
             
-    os.remove(f'{args.temppath}/{UUID}.ckp')
+    remove_checkpoint(UUID, args.temppath)
     
     return nn, early_stop, lossfunction, current_epoch
 
@@ -129,38 +136,38 @@ def al_train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optim
     start_training_time = time.time()
     UUID += '_AL'
     
-    C = math.inf
-    N_update = 0
+    multiplier = MultiplierUpdate(args)
+    # inexact inner solves stop at AL_LR_MIN until the constraint is satisfied, then training continues down to LR_MIN
+    exact = not args.AL_LR_MIN > args.LR_MIN
+    feasible = False
     current_epoch = 0
     
-    while C > 0.:
-        nn, early_stop, lossfunction, current_epoch = train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID)
+    while not (feasible and exact):
+        lr_min = args.LR_MIN if exact else args.AL_LR_MIN
+        nn, early_stop, lossfunction, current_epoch = train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID, lr_min)
     
         if not early_stop:
-            nn, early_stop, lossfunction, current_epoch = train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID)
+            nn, early_stop, lossfunction, current_epoch = train_pnn_progressive(nn, train_loader, valid_loader, lossfunction, optimizer, args, logger, current_epoch, UUID, lr_min)
         else:
-            N_update += 1
             logger.info(f'Training converged, update lambda.')
             print(f'Training converged, update lambda.')
             
             # update lambda
-            for x, y in train_loader:
-                lossfunction(nn, x, y)
-            C = lossfunction.constraint(nn)
+            with torch.no_grad():
+                C = lossfunction.constraint(nn, Evaluator(args).MeanPower(nn, train_loader))
+            logger.info(f'Constraint violation {C.item():.3e} after epoch {current_epoch}.')
 
-            if C > 0.:
-                temp = (lossfunction.args.lambda_ + lossfunction.args.mu * lossfunction.constraint(nn)).data.clone()
-                if temp <= 0.:
-                    lossfunction.args.lambda_ = 0.
-                else:
-                    lossfunction.args.lambda_ = temp.item()
-                
-                lossfunction.args.mu += 100.
+            if multiplier.Feasible(C):
+                # an inexact solve is continued down to LR_MIN and checked again
+                feasible = exact
+                exact = True
+            else:
+                lossfunction = multiplier(lossfunction, C)
     
                 # reset learning inital learning rate
                 for g in optimizer.param_groups:
                     g['params'] = [p for p in nn.parameters()]
-                    g['lr'] = 5 * args.LR / (N_update + 5)
+                    g['lr'] = 5 * args.LR / (multiplier.N_update + 5)
                     current_lr = g['lr']
                 logger.info(f'lr reset to {current_lr}.')
                 print(f'lr reset to {current_lr}.')
@@ -0,0 +1,203 @@
+import os
+import time
+import math
+import torch
+from .checkpoint import *
+from .evaluation import *
+from .lagrangian import *
+from .crossbar import pNNStack
+from .Loader import SeededLoader
+
+# ================================================================================================================================================
+# ==========================================================  Lockstep Training of pNNs  =========================================================
+# ================================================================================================================================================
+# several pNNs with the same topology (e.g. different seeds) are trained in one process with a batched forward pass (pNNStack),
+# each pNN keeps its own optimizer, early stopping, learning rate and augmented lagrangian multipliers,
+# following the same schedule as train_pnn / train_pnn_progressive / al_train_pnn_progressive,
+# the input noise of each pNN is drawn from its own generator, in the same order as in its own run of experiment.py,
+# the best network of each pNN is checkpointed under its own UUID for crash recovery
+
+class SeedState():
+    def __init__(self, nn, lossfunction, optimizer, args, logger, generator=None, UUID=None):
+        self.nn = nn
+        self.lossfunction = lossfunction
+        self.optimizer = optimizer
+        self.args = args
+        self.logger = logger
+        # None: seeded as by SetSeed(args.SEED)
+        self.generator = torch.Generator().manual_seed(args.SEED) if generator is None else generator
+        self.UUID = UUID
+        self.temppath = os.getenv('TMPDIR', default='.')
+
+        self.epoch = 0
+        self.best_valid_loss = math.inf
+        self.patience = 0
+        self.multiplier = MultiplierUpdate(args)
+        self.exact = not (args.powerestimator == 'AL' and args.AL_LR_MIN > args.LR_MIN)
+        self.finished = False
+        self.Resume()
+        self.best = self.Snapshot()
+
+    def Resume(self):
+        # continue from the checkpoint of an interrupted training
+        if self.UUID is None:
+            return
+        checkpoint = load_checkpoint(self.UUID, self.temppath, self.nn, self.optimizer, self.lossfunction, self.generator)
+        if checkpoint:
+            self.epoch, self.nn, self.optimizer, self.best_valid_loss, self.lossfunction = checkpoint
+            self.Info(f'Restart previous training from {self.epoch} epoch')
+
+    def Save(self, persist=False):
+        if self.UUID is not None:
+            save_checkpoint(self.epoch, self.nn, self.optimizer, self.best_valid_loss, self.lossfunction, self.UUID, self.temppath,
+                            persist=persist, generator=self.generator)
+
+    def Persist(self):
+        if self.UUID is not None:
+            persist_checkpoint(self.UUID, self.temppath)
+
+    def Finish(self):
+        self.finished = True
+        if self.UUID is not None:
+            remove_checkpoint(self.UUID, self.temppath)
+
+    @property
+    def lr(self):
+        for g in self.optimizer.param_groups:
+            current_lr = g['lr']
+        return current_lr
+
+    def Snapshot(self):
+        # the random state is restored with the best network, as by load_checkpoint in train_pnn
+        return [p.detach().clone() for p in self.nn.parameters() if p.requires_grad], self.generator.get_state()
+
+    def Restore(self):
+        parameters, random_state = self.best
+        with torch.no_grad():
+            for p, b in zip([p for p in self.nn.parameters() if p.requires_grad], parameters):
+                p.copy_(b)
+        self.generator.set_state(random_state)
+
+    def Restart(self, lr):
+        # warm start from the best network, the optimizer covers all parameters and starts without state,
+        # as after reloading the checkpoint in train_pnn_progressive
+        self.Restore()
+        self.optimizer = torch.optim.Adam([p for p in self.nn.parameters()], lr=lr)
+        self.best_valid_loss = math.inf
+        self.patience = 0
+        self.Save(persist=True)
+
+    def Info(self, msg):
+        self.logger.info(msg)
+        print(f'Seed {self.args.SEED}: {msg}')
+
+    def Track(self, L_valid):
+        # returns True if early stopped
+        if L_valid < self.best_valid_loss:
+            self.best_valid_loss = L_valid
+            self.best = self.Snapshot()
+            self.Save()
+            self.patience = 0
+        else:
+            self.patience += 1
+        return self.patience > self.args.PATIENCE
+
+    def EarlyStop(self, epoch, train_loader):
+        self.logger.info('Early stop.')
+        self.logger.info(f'load best network to warm start training with lower lr, current epoch {epoch}.')
+        lr = self.lr * self.args.LR_DECAY
+        self.Restart(lr)
+        self.logger.info(f'lr update to {lr}.')
+        if lr <= (self.args.LR_MIN if self.exact else self.args.AL_LR_MIN):
+            self.EndProgressive(train_loader)
+
+    def EndProgressive(self, train_loader):
+        if not self.args.powerestimator == 'AL':
+            self.Finish()
+            return
+
+        self.Info('Training converged, update lambda.')
+        with torch.no_grad():
+            power = Evaluator(self.args).MeanPower(self.nn, SeededLoader(train_loader, self.generator))
+            C = self.lossfunction.constraint(self.nn, power)
+        self.logger.info(f'Constraint violation {C.item():.3e}.')
+
+        if self.multiplier.Feasible(C):
+            # an inexact solve is continued down to LR_MIN and checked again
+            if self.exact:
+                self.Finish()
+            self.exact = True
+        else:
+            self.multiplier(self.lossfunction, C)
+            lr = 5 * self.args.LR / (self.multiplier.N_update + 5)
+            self.Restart(lr)
+            self.Info(f'lr reset to {lr}.')
+
+
+def lockstep_train_pnn(states, train_loader, valid_loader, args):
+    start_training_time = time.time()
+
+    evaluator = Evaluator(args)
+    evaluator.SelectMetric()
+    N_train, N_valid = len(train_loader.dataset), len(valid_loader.dataset)
+
+    while not all([s.finished for s in states]):
+        start_epoch_time = time.time()
+
+        active = [s for s in states if not s.finished]
+        stack = pNNStack([s.nn for s in active])
+
+        # gradients are accumulated over the batches (MAX_BATCH) and each pNN steps once per epoch, as in train_pnn
+        for s in active:
+            s.optimizer.zero_grad()
+        L_train, train_acc, train_power = [0.] * len(active), [0.] * len(active), [0.] * len(active)
+        for batches in zip(*[SeededLoader(train_loader, s.generator) for s in active]):
+            weight = batches[0][0].shape[0] / N_train
+            prediction = stack(torch.stack([x for x, _ in batches]))
+            losses = []
+            for i, (s, p, (_, y)) in enumerate(zip(active, prediction, batches)):
+                power = s.nn.PowerBreakdown['total']
+                L = s.lossfunction.objective(p, y, power)
+                losses.append(L * weight)
+                L_train[i] += L.detach() * weight
+                train_acc[i] += evaluator.performance(p, y) * weight
+                train_power[i] += power.detach() * weight
+            # the pNNs share no parameters, the sum yields the gradient of each pNN w.r.t. its own loss
+            torch.stack([L.sum() for L in losses]).sum().backward()
+        for s in active:
+            s.optimizer.step()
+
+        L_valid, valid_acc = [0.] * len(active), [0.] * len(active)
+        with torch.no_grad():
+            for batches in zip(*[SeededLoader(valid_loader, s.generator) for s in active]):
+                weight = batches[0][0].shape[0] / N_valid
+                prediction = stack(torch.stack([x for x, _ in batches]))
+                for i, (s, p, (_, y)) in enumerate(zip(active, prediction, batches)):
+                    L_valid[i] += s.lossfunction.objective(p, y, s.nn.Power) * weight
+                    valid_acc[i] += evaluator.performance(p, y) * weight
+
+        end_epoch_time = time.time()
+
+        for i, s in enumerate(active):
+            epoch = s.epoch
+            if s.Track(L_valid[i].item()):
+                s.EarlyStop(epoch, train_loader)
+            elif not epoch % args.report_freq:
+                msg = f'| Epoch: {epoch:-6d} | Train loss: {L_train[i].item():.4f} | Valid loss: {L_valid[i].item():.4f} | Train acc: {train_acc[i]:.4f} | Valid acc: {valid_acc[i]:.4f} |'\
+                      f' patience: {s.patience:-3d} | lr: {s.lr:.3e} | Epoch time: {end_epoch_time-start_epoch_time:.1f} |'\
+                      f' Power: {train_power[i].item():.2e} | lambda: {s.lossfunction.args.lambda_:.3e} | mu: {s.lossfunction.args.mu:.3e} |'
+                print(f'| Seed: {s.args.SEED:-3d} ' + msg)
+                s.logger.info(msg)
+            if not s.finished and args.ckp_freq and not epoch % args.ckp_freq:
+                s.Persist()
+            s.epoch += 1
+
+        if (time.time() - start_training_time) >= args.TIMELIMITATION*60*60:
+            print('Time limination reached.')
+            for s in states:
+                s.logger.warning('Time limination reached.')
+                if not s.finished:
+                    s.Persist()
+            return False
+
+    return True
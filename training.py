@@ -65,4 +65,113 @@ def train_nn(nn, train_loader, valid_loader, lossfunction, optimizer, UUID='defa
     os.remove(f'./temp/NN_{UUID}_{training_ID}')
     
     print('Finished.')
-    return resulted_nn, train_loss, valid_loss
\ No newline at end of file
+    return resulted_nn, train_loss, valid_loss
+
+# grid training: many MLPs of the same shape (e.g. seeds and learning rates of one topology) trained together,
+# weights are stacked to [S, ...] and evaluated with batched matmuls, each model keeps its own data order, early stopping and best weights
+
+class StackedMLP(torch.nn.Module):
+    def __init__(self, models):
+        super().__init__()
+        linears = [[m for m in model if isinstance(m, torch.nn.Linear)] for model in models]
+        prelus = [[m for m in model if isinstance(m, torch.nn.PReLU)] for model in models]
+        self.weights = torch.nn.ParameterList([torch.stack([l[t].weight.detach() for l in linears]) for t in range(len(linears[0]))])
+        self.biases = torch.nn.ParameterList([torch.stack([l[t].bias.detach() for l in linears]) for t in range(len(linears[0]))])
+        self.slopes = torch.nn.ParameterList([torch.stack([p[t].weight.detach() for p in prelus]) for t in range(len(prelus[0]))])
+
+    def forward(self, x):
+        # x: [S, B, N_in] -> [S, B, N_out]
+        for W, b, a in zip(self.weights, self.biases, self.slopes):
+            x = torch.baddbmm(b.unsqueeze(1), x, W.transpose(1, 2))
+            x = torch.where(x >= 0, x, a.unsqueeze(1) * x)
+        return x
+
+    def Select(self, keep):
+        # sub-stack of the models in keep, as new leaf parameters
+        for params in [self.weights, self.biases, self.slopes]:
+            for t in range(len(params)):
+                params[t] = torch.nn.Parameter(params[t].detach()[keep])
+        return self
+
+    def Export(self, s, model):
+        # weights of the s-th model into a torch.nn.Sequential of the same shape
+        linears = [m for m in model if isinstance(m, torch.nn.Linear)]
+        prelus = [m for m in model if isinstance(m, torch.nn.PReLU)]
+        with torch.no_grad():
+            for t in range(len(linears)):
+                linears[t].weight.copy_(self.weights[t][s])
+                linears[t].bias.copy_(self.biases[t][s])
+                prelus[t].weight.copy_(self.slopes[t][s])
+        return model
+
+
+def train_nn_grid(models, lrs, seeds, train_loader, valid_loader, patience_max=2500):
+    # models: list of torch.nn.Sequential of the same shape, each trained with Adam(lr=lrs[s]) and shuffled with seeds[s]
+    # returns the models with their best weights and the train / valid loss curves of each model
+    S = len(models)
+    X_train, y_train = [torch.cat(t) for t in zip(*[(x, y) for x, y in train_loader])]
+    X_valid, y_valid = [torch.cat(t) for t in zip(*[(x, y) for x, y in valid_loader])]
+    batch_size = train_loader.batch_size
+    generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    stack = StackedMLP(models)
+    best = StackedMLP(models)
+    # all models use Adam with lr=1, the steps are scaled by the learning rate of each model afterwards
+    lr = torch.tensor(lrs, dtype=X_train.dtype)
+    optimizer = torch.optim.Adam(stack.parameters(), lr=1.)
+
+    train_loss = [[] for _ in range(S)]
+    valid_loss = [[] for _ in range(S)]
+    best_valid_loss = torch.full([S], math.inf)
+    patience = torch.zeros([S], dtype=torch.long)
+    active = torch.arange(S)
+
+    for epoch in range(10**10):
+        index = torch.stack([torch.randperm(X_train.shape[0], generator=generators[s]) for s in active.tolist()])
+        total_loss = torch.zeros([len(active)])
+        for start in range(0, X_train.shape[0], batch_size):
+            batch = index[:, start:start+batch_size]
+            prediction_train = stack(X_train[batch])
+            L_train = (prediction_train - y_train[batch]).pow(2).mean(dim=(1, 2))
+            total_loss += L_train.detach() * batch.shape[1]
+
+            optimizer.zero_grad()
+            L_train.sum().backward()
+            before = [p.detach().clone() for p in stack.parameters()]
+            optimizer.step()
+            with torch.no_grad():
+                for p, b in zip(stack.parameters(), before):
+                    p.copy_(b + lr[active].view(-1, *[1] * (p.dim() - 1)) * (p - b))
+
+        with torch.no_grad():
+            prediction_valid = stack(X_valid.expand(len(active), *X_valid.shape))
+            L_valid = (prediction_valid - y_valid).pow(2).mean(dim=(1, 2))
+
+        for i, s in enumerate(active.tolist()):
+            train_loss[s].append(total_loss[i].item() / X_train.shape[0])
+            valid_loss[s].append(L_valid[i].item())
+
+        improved = L_valid < best_valid_loss[active]
+        best_valid_loss[active] = torch.where(improved, L_valid, best_valid_loss[active])
+        patience[active] = torch.where(improved, torch.zeros_like(patience[active]), patience[active] + 1)
+        with torch.no_grad():
+            for p_best, p in zip(best.parameters(), stack.parameters()):
+                p_best[active[improved]] = p[improved]
+
+        if not epoch % 500:
+            print(f'| Epoch: {epoch:-8d} | Valid loss: {L_valid.min().item():.5f} - {L_valid.max().item():.5f} | Active: {len(active):-4d} |')
+
+        # early stopped models leave the stack, the optimizer keeps the state of the remaining ones
+        keep = patience[active] <= patience_max
+        if not keep.all():
+            active = active[keep]
+            if not len(active):
+                break
+            state = [optimizer.state[p] for p in stack.parameters()]
+            stack.Select(keep)
+            optimizer = torch.optim.Adam(stack.parameters(), lr=1.)
+            for p, s in zip(stack.parameters(), state):
+                optimizer.state[p] = {'step': s['step'], 'exp_avg': s['exp_avg'][keep], 'exp_avg_sq': s['exp_avg_sq'][keep]}
+
+    print('Finished.')
+    return [best.Export(s, model) for s, model in enumerate(models)], train_loss, valid_loss